@@ -0,0 +1,294 @@
+# Acceleration structures for ray-leaf queries.
+# UniformGrid bins the leaf disks of a scene into regular cells; rays walk the cells they
+# cross with a 3D-DDA, so only leaves close to the ray are ever tested.
+
+import numpy as np
+import geometry
+import instrument
+
+
+def reduce_nearest(ray, t, ids, t_best, id_best):
+    # Keeps, for every ray, the closest of the candidate hits (ray[i], t[i], ids[i]) and of
+    # its current best (t_best, id_best are updated in place). Rays may repeat
+    ok = t < t_best[ray]
+    ray, t, ids = ray[ok], t[ok], ids[ok]
+    if len(t) == 0:
+        return
+    order = np.lexsort((t, ray))
+    ray, t, ids = ray[order], t[order], ids[order]
+    first = np.r_[True, ray[1:] != ray[:-1]]
+    t_best[ray[first]] = t[first]
+    id_best[ray[first]] = ids[first]
+
+
+def _local(count):
+    # 0..count[i]-1 for every row i, concatenated
+    return np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+
+
+def expand(start, count, items):
+    # (row, item) pairs listing items[start[i]:start[i]+count[i]] for every row i, e.g.
+    # the contents of CSR cells
+    pr = np.repeat(np.arange(len(start)), count)
+    return pr, items[np.repeat(start, count) + _local(count)]
+
+
+def csr(cell, items, ncell):
+    # CSR lists of the (cell, item) pairs: the items of cell c are
+    # items[start[c]:start[c+1]] of the returned (start, items), in their original order
+    order = np.argsort(cell, kind='stable')
+    start = np.zeros(ncell + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cell, minlength=ncell), out=start[1:])
+    return start, items[order]
+
+
+def box_cells(i0, i1):
+    # (row, ijk) pairs listing every cell of the integer box i0[i]..i1[i] (inclusive) for
+    # every row i, e.g. the grid cells overlapped by a bounding box
+    span = i1 - i0 + 1
+    count = np.prod(span, axis=1)
+    local = _local(count)
+    sy = np.repeat(span[:,1], count)
+    sz = np.repeat(span[:,2], count)
+    ijk = np.repeat(i0, count, axis=0)
+    ijk[:,0] += local//(sy*sz)
+    ijk[:,1] += (local//sz) % sy
+    ijk[:,2] += local % sz
+    return np.repeat(np.arange(len(i0)), count), ijk
+
+
+class UniformGrid:
+    # Leaves are binned once into CSR cells. Leaves inserted or moved afterwards (update)
+    # go to a small sorted list of extra (cell, leaf) pairs searched alongside the CSR
+    # cells, so edits cost in proportion to the leaves changed; stale CSR entries of moved
+    # leaves only cost extra tests. The CSR is rebuilt once the extra pairs outgrow a
+    # fraction of it, or when a leaf leaves the grid box
+
+    def __init__(self, center, normal, radius, const=None, cell_size=None, max_cells=1<<22,
+                 active=None):
+        # center, normal (m,3), radius (m,) describe the disks, const from
+        # geometry.disk_constants. By default cells are about one leaf diameter wide.
+        # active: optional (m,) mask of the leaves to bin, the others can never be hit
+        self.rebind(center, normal, radius, const)
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self.active = None if active is None else np.asarray(active, dtype=bool)
+        self._build()
+
+    def rebind(self, center, normal, radius, const=None):
+        # Points the grid at new leaf arrays (e.g. after the scene reallocated them)
+        self.center = np.asarray(center, dtype=float)
+        self.normal = np.asarray(normal, dtype=float)
+        self.radius = np.asarray(radius, dtype=float)
+        if const is None:
+            const = geometry.disk_constants(self.normal, self.center, self.radius)
+        self.const = const
+        self.nleaves = len(self.radius)
+
+    def _ids(self, ids):
+        # leaves of ids that are binned
+        if self.active is None:
+            return ids
+        return ids[self.active[ids]]
+
+    def _build(self):
+        self.extra_cell = np.zeros(0, dtype=np.int64)
+        self.extra_item = np.zeros(0, dtype=np.int64)
+        ids = self._ids(np.arange(self.nleaves))
+        if len(ids) == 0:
+            self.lo = np.zeros(3)
+            self.cell = np.ones(3)
+            self.dims = np.ones(3, dtype=np.int64)
+            self.cell_start = np.zeros(2, dtype=np.int64)
+            self.cell_items = np.zeros(0, dtype=np.int64)
+            return
+
+        lo, hi = geometry.disk_aabb(self.normal[ids], self.center[ids], self.radius[ids])
+        pad = 1e-6*(1 + np.max(np.abs(hi)))
+        self.lo = lo.min(axis=0) - pad
+        size = hi.max(axis=0) + pad - self.lo
+
+        cell_size = self.cell_size
+        if cell_size is None:
+            cell_size = 2*np.mean(self.radius[ids])
+        cell_size = float(cell_size)
+        while np.prod(np.ceil(size/cell_size)) > self.max_cells:
+            cell_size *= 1.5
+        self.dims = np.maximum(np.ceil(size/cell_size).astype(np.int64), 1)
+        self.cell = size/self.dims
+
+        self._bin(ids, lo, hi)
+
+
+    def _pairs(self, ids, lo, hi):
+        # (cell, leaf) pairs for every cell overlapped by the bounding box of leaves ids
+        row, ijk = box_cells(self._cell_index(lo), self._cell_index(hi))
+        return self._linear(ijk), ids[row]
+
+    def _bin(self, ids, lo, hi):
+        # Inserts disks ids in all cells overlapped by their bounding box and stores the
+        # result in CSR form: leaves of cell c are cell_items[cell_start[c]:cell_start[c+1]]
+        cid, leaf_id = self._pairs(ids, lo, hi)
+        self.cell_start, self.cell_items = csr(cid, leaf_id, int(np.prod(self.dims)))
+
+
+    def update(self, ids):
+        # Refits the grid after leaves ids were inserted or moved (the grid must already
+        # be bound to the current arrays). Removed leaves need no update as long as they
+        # can no longer be hit (r2 < 0)
+        ids = self._ids(np.asarray(ids, dtype=np.int64))
+        if len(ids) == 0:
+            return
+        lo, hi = geometry.disk_aabb(self.normal[ids], self.center[ids], self.radius[ids])
+        top = self.lo + self.dims*self.cell
+        if self.nleaves == len(ids) or len(self.cell_items) == 0 or np.any(lo < self.lo) or \
+                np.any(hi > top) or \
+                len(self.extra_item) + len(ids) > max(1024, len(self.cell_items)//4):
+            if instrument.enabled:
+                instrument.count('grid_rebuilds')
+            self._build()
+            return
+        cid, leaf_id = self._pairs(ids, lo, hi)
+        cell = np.concatenate([self.extra_cell, cid])
+        item = np.concatenate([self.extra_item, leaf_id])
+        order = np.argsort(cell, kind='stable')
+        self.extra_cell, self.extra_item = cell[order], item[order]
+
+
+    def _cell_index(self, x):
+        ijk = np.floor((x - self.lo)/self.cell).astype(np.int64)
+        return np.clip(ijk, 0, self.dims - 1)
+
+    def _linear(self, ijk):
+        return (ijk[:,0]*self.dims[1] + ijk[:,1])*self.dims[2] + ijk[:,2]
+
+    def cell_of(self, pos):
+        # Linear index of the cell containing each position (clamped to the grid)
+        return self._linear(self._cell_index(pos))
+
+
+    def _enter(self, pos, direction):
+        # Distance along each ray to where it enters and leaves the grid (slab test)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            invdir = 1./direction
+            ta = (self.lo - pos)*invdir
+            tb = (self.lo + self.dims*self.cell - pos)*invdir
+        ta = np.where(np.isnan(ta), -np.inf, ta)
+        tb = np.where(np.isnan(tb), np.inf, tb)
+        t0 = np.maximum(np.max(np.minimum(ta, tb), axis=1), 0.)
+        t1 = np.min(np.maximum(ta, tb), axis=1)
+        return t0, t1, invdir
+
+
+    def nearest(self, pos, direction, skip=None, tol=1e-6, one_sided=True, any_hit=False):
+        # Closest leaf hit along each ray. pos, direction: (n,3). skip: optional (n,) leaf
+        # index ignored for each ray. Returns distance (inf if no hit) and leaf index
+        # (-1 if no hit). With any_hit a ray stops at the first cell where it hits a leaf,
+        # which need not be the closest: enough for shadow rays
+        n = len(pos)
+        t_best = np.full(n, np.inf)
+        id_best = np.full(n, -1, dtype=np.int64)
+        if self.nleaves == 0 or n == 0:
+            return t_best, id_best
+
+        t0, t1, invdir = self._enter(pos, direction)
+        ray = np.flatnonzero(t0 <= t1)
+        if len(ray) == 0:
+            return t_best, id_best
+
+        # DDA state for the rays that cross the grid
+        ijk = self._cell_index(pos[ray] + t0[ray,None]*direction[ray])
+        step = np.where(direction[ray] > 0, 1, -1)
+        with np.errstate(invalid='ignore'):
+            bound = self.lo + (ijk + (step > 0))*self.cell
+            t_next = np.where(direction[ray] != 0, (bound - pos[ray])*invdir[ray], np.inf)
+            t_delta = np.where(direction[ray] != 0, self.cell*np.abs(invdir[ray]), np.inf)
+        t_exit = t1[ray]
+
+        while len(ray) > 0:
+            cid = self._linear(ijk)
+            start = self.cell_start[cid]
+            count = self.cell_start[cid+1] - start
+
+            # expand (ray, leaf) pairs of the current cells
+            pr, pl = expand(start, count, self.cell_items)
+            if len(self.extra_item) > 0:
+                e0 = np.searchsorted(self.extra_cell, cid, side='left')
+                e1 = np.searchsorted(self.extra_cell, cid, side='right')
+                er, el = expand(e0, e1 - e0, self.extra_item)
+                pr, pl = np.concatenate([pr, er]), np.concatenate([pl, el])
+            if skip is not None:
+                keep = pl != skip[ray[pr]]
+                pr, pl = pr[keep], pl[keep]
+
+            if instrument.enabled:
+                instrument.count('grid_cells', len(ray))
+                instrument.count('leaf_tests', len(pl))
+            if len(pl) > 0:
+                const = {'d': self.const['d'][pl], 'r2': self.const['r2'][pl]}
+                t = geometry.do_raydisk_pairs(pos[ray[pr]], direction[ray[pr]],
+                        self.normal[pl], self.center[pl], const, tol=tol, one_sided=one_sided)
+                reduce_nearest(ray[pr], t, pl, t_best, id_best)
+
+            # a hit is final once it lies before the exit of the current cell
+            t_cell = np.min(t_next, axis=1)
+            done = t_best[ray] < np.inf if any_hit else t_best[ray] <= t_cell
+            axis = np.argmin(t_next, axis=1)
+            rows = np.arange(len(ray))
+            ijk[rows, axis] += step[rows, axis]
+            t_next[rows, axis] += t_delta[rows, axis]
+
+            outside = np.any((ijk < 0) | (ijk >= self.dims), axis=1) | (t_cell > t_exit)
+            keep = ~(done | outside)
+            ray, ijk, step = ray[keep], ijk[keep], step[keep]
+            t_next, t_delta, t_exit = t_next[keep], t_delta[keep], t_exit[keep]
+
+        return t_best, id_best
+
+
+def nearest_by_bbox(pos, direction, invdir, leaves, bounds, skip_leaf, tol = 1e-6,
+                    one_sided = True, any_hit = False, active = None):
+    # Brute-force alternative to UniformGrid.nearest over the packed leaves of a scene
+    # (scene_conf.pack_leaves). A single slab test against all bboxes selects, per bbox,
+    # the rays that cross it before their current best hit; those rays are then tested
+    # against every leaf of the bbox. Returns distances (inf if no hit) and global leaf
+    # indices (-1 if no hit). With any_hit rays that hit a leaf are not searched further.
+    # active: optional per-bbox mask, the leaves of other bboxes are never tested
+    t_best = np.full(len(pos), np.inf)
+    id_best = np.full(len(pos), -1, dtype=np.int64)
+    offset = leaves['offset']
+
+    with instrument.phase('bbox_search'):
+        tmin, tmax = geometry.raybox_interval(pos, invdir, bounds)
+        tenter = np.where(tmax >= np.maximum(tmin, 0), np.maximum(tmin, 0), np.inf)
+    if instrument.enabled:
+        instrument.count('bbox_tests', tenter.size)
+        ntested = np.zeros(len(pos), dtype=np.int64)
+
+    for ibb in np.argsort(np.min(tenter, axis=0)):
+        i0, i1 = offset[ibb], offset[ibb+1]
+        if i0 == i1 or (active is not None and not active[ibb]):
+            continue
+        sel = tenter[:,ibb] < t_best
+        if any_hit:
+            sel &= id_best < 0
+        sel = np.flatnonzero(sel)
+        if len(sel) == 0:
+            continue
+        if instrument.enabled:
+            instrument.count('leaf_tests', len(sel)*(i1 - i0))
+            ntested[sel] += 1
+        const = {k: leaves[k][i0:i1] for k in ('d', 'r2', 'cc')}
+        with instrument.phase('leaf_search'):
+            t, il = geometry.do_raydisk_batch(pos[sel], direction[sel], leaves['normal'][i0:i1],
+                        leaves['center'][i0:i1], const, skip=skip_leaf[sel] - i0, tol=tol,
+                        one_sided=one_sided)
+        closer = t < t_best[sel]
+        t_best[sel[closer]] = t[closer]
+        id_best[sel[closer]] = i0 + il[closer]
+
+    if instrument.enabled:
+        # bboxes never searched for a ray, and bboxes searched after the first one
+        instrument.count('bbox_skipped', tenter.size - ntested.sum())
+        instrument.count('skip_list_retries', np.maximum(ntested - 1, 0).sum())
+    return t_best, id_best
@@ -1 +1,244 @@
 # This module should contain routines to deal with atmosphere transmission
+#
+# Clear-sky direct and diffuse irradiance on a horizontal surface are tabulated once over
+# sun zenith angle and wavelength, together with the angular distribution of the sky
+# radiance over view zenith and azimuth relative to the sun. Tables are cached on disk and
+# interpolated for whole photon batches, so runs only do lookups.
+#
+# The model is deliberately simple: extraterrestrial spectrum from a 5778 K black body
+# scaled to the solar constant, Rayleigh and Angstrom aerosol extinction with the
+# Kasten-Young air mass, single scattering for the diffuse part, and the CIE clear sky
+# radiance distribution. For a horizontally homogeneous atmosphere the irradiances do not
+# depend on the sun azimuth; only the sky distribution is azimuth dependent, and it is
+# tabulated relative to the sun.
+
+import os
+import json
+import hashlib
+import numpy as np
+
+TABLE_VERSION = 1
+
+SOLAR_CONSTANT = 1361. # W m-2
+
+# CIE standard clear sky (type 12): gradation a, b and indicatrix c, d, e
+CIE_CLEAR = (-1., -0.32, 10., -3., 0.45)
+
+default_params = {'aod550': 0.1,   # aerosol optical depth at 550 nm
+                  'angstrom': 1.3, # Angstrom exponent
+                  'ssa': 0.9,      # aerosol single scattering albedo
+                  'forward': 0.85} # fraction of aerosol scattering going downwards
+
+
+def extraterrestrial(wavelengths):
+    # Solar spectral irradiance at the top of the atmosphere, W m-2 nm-1
+    wl = np.asarray(wavelengths, dtype=float)*1e-9
+    h, c, k = 6.626e-34, 2.998e8, 1.381e-23
+    planck = 1/(wl**5*(np.exp(h*c/(wl*k*5778.)) - 1))
+    # scaled so that the integral over all wavelengths is the solar constant
+    total = np.pi**4*(k*5778.)**4/(15*(h*c)**4)
+    return SOLAR_CONSTANT*planck/total*1e-9
+
+
+def air_mass(zenith):
+    # Kasten and Young (1989); zenith in radians, inf below the horizon
+    zd = np.degrees(zenith)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        m = 1/(np.cos(zenith) + 0.50572*(96.07995 - zd)**-1.6364)
+    return np.where(zd < 90, m, np.inf)
+
+
+def optical_depths(wavelengths, params):
+    # Rayleigh and aerosol optical depths at wavelengths (nm)
+    um = np.asarray(wavelengths, dtype=float)*1e-3
+    tau_r = 0.008569*um**-4*(1 + 0.0113*um**-2 + 0.00013*um**-4)
+    tau_a = params['aod550']*(um/0.55)**-params['angstrom']
+    return tau_r, tau_a
+
+
+def _cie_relative(sun_zenith, view_zenith, azimuth):
+    # CIE sky radiance relative to the zenith, azimuth measured from the sun
+    a, b, c, d, e = CIE_CLEAR
+    cos_chi = np.cos(sun_zenith)*np.cos(view_zenith) + \
+        np.sin(sun_zenith)*np.sin(view_zenith)*np.cos(azimuth)
+    chi = np.arccos(np.clip(cos_chi, -1, 1))
+    gradation = 1 + a*np.exp(b/np.maximum(np.cos(view_zenith), 1e-3))
+    indicatrix = 1 + c*(np.exp(d*chi) - np.exp(d*np.pi/2)) + e*cos_chi**2
+    return gradation*indicatrix
+
+
+def _interp_axis(grid, x):
+    # Bracketing indices and weights of x on an increasing grid, clamped at the ends
+    f = np.interp(x, grid, np.arange(len(grid)))
+    i0 = np.minimum(np.floor(f).astype(np.int64), len(grid) - 2) if len(grid) > 1 else \
+        np.zeros(np.shape(f), dtype=np.int64)
+    i1 = np.minimum(i0 + 1, len(grid) - 1)
+    return i0, i1, f - i0
+
+
+class SkyTables:
+    # direct, diffuse: (nzenith, nbands) horizontal irradiances in W m-2 nm-1.
+    # sky_pdf: (nzenith, nview, nazimuth) probability of a diffuse photon coming from each
+    # (view zenith, azimuth from the sun) cell, cos-weighted so that it is the share of the
+    # horizontal diffuse irradiance
+    arrays = ('zenith', 'wavelengths', 'direct', 'diffuse', 'view_edges', 'azimuth_edges',
+              'sky_pdf')
+
+    def __init__(self, zenith, wavelengths, direct, diffuse, view_edges, azimuth_edges,
+                 sky_pdf, params=None):
+        self.zenith = np.asarray(zenith, dtype=float)
+        self.wavelengths = np.asarray(wavelengths, dtype=float)
+        self.direct = np.asarray(direct, dtype=float)
+        self.diffuse = np.asarray(diffuse, dtype=float)
+        self.view_edges = np.asarray(view_edges, dtype=float)
+        self.azimuth_edges = np.asarray(azimuth_edges, dtype=float)
+        self.sky_pdf = np.asarray(sky_pdf, dtype=float)
+        self.params = dict(default_params if params is None else params)
+
+    @classmethod
+    def compute(cls, zenith = None, wavelengths = None, nview = 18, nazimuth = 36,
+                params = None):
+        # zenith in radians (default 0 to 89 degrees), wavelengths in nm (default 300 to
+        # 2500 nm every 10 nm)
+        params = {**default_params, **(params or {})}
+        if zenith is None:
+            zenith = np.radians(np.arange(0, 90.))
+        if wavelengths is None:
+            wavelengths = np.arange(300, 2501, 10.)
+        zenith = np.asarray(zenith, dtype=float)
+        wavelengths = np.asarray(wavelengths, dtype=float)
+
+        tau_r, tau_a = optical_depths(wavelengths, params)
+        m = air_mass(zenith)[:,None]
+        mu = np.maximum(np.cos(zenith), 0)[:,None]
+        e0 = extraterrestrial(wavelengths)[None,:]
+        with np.errstate(invalid='ignore'):
+            t_r = np.exp(-tau_r*m)
+            t_as = np.exp(-params['ssa']*tau_a*m)
+            t_aa = np.exp(-(1 - params['ssa'])*tau_a*m)
+        direct = e0*mu*t_r*t_as*t_aa
+        # half of the Rayleigh scattered light and a fraction 'forward' of the aerosol
+        # scattered light reach the ground, all of it attenuated by aerosol absorption
+        diffuse = e0*mu*t_aa*(0.5*(1 - t_r) + params['forward']*t_r*(1 - t_as))
+        direct = np.nan_to_num(direct)
+        diffuse = np.nan_to_num(diffuse)
+
+        view_edges = np.linspace(0, np.pi/2, nview + 1)
+        azimuth_edges = np.linspace(0, 2*np.pi, nazimuth + 1)
+        vz = 0.5*(view_edges[1:] + view_edges[:-1])
+        az = 0.5*(azimuth_edges[1:] + azimuth_edges[:-1])
+        # cell weight: radiance x integral of cos(z) sin(z) dz dphi over the cell
+        solid = 0.5*np.diff(np.sin(view_edges)**2)[:,None]*np.diff(azimuth_edges)[None,:]
+        rad = _cie_relative(zenith[:,None,None], vz[None,:,None], az[None,None,:])
+        sky_pdf = rad*solid[None]
+        sky_pdf /= sky_pdf.sum(axis=(1,2), keepdims=True)
+
+        return cls(zenith, wavelengths, direct, diffuse, view_edges, azimuth_edges, sky_pdf,
+                   params)
+
+    def save(self, path):
+        np.savez(path, **{k: getattr(self, k) for k in self.arrays},
+                 meta=json.dumps({'version': TABLE_VERSION, 'params': self.params}))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            meta = json.loads(str(f['meta']))
+            if meta['version'] != TABLE_VERSION:
+                raise ValueError(f'{path}: sky table version {meta["version"]}, '
+                                 f'expected {TABLE_VERSION}')
+            return cls(*[f[k] for k in cls.arrays], params=meta['params'])
+
+    def irradiance(self, zenith, wavelengths = None):
+        # Direct and diffuse horizontal irradiance for an array of sun zenith angles (n,),
+        # bilinear in zenith and wavelength. Returns two (n, nbands) arrays, on the table
+        # wavelengths if wavelengths is None
+        zenith = np.atleast_1d(np.asarray(zenith, dtype=float))
+        i0, i1, w = _interp_axis(self.zenith, zenith)
+        w = w[:,None]
+        out = []
+        for table in (self.direct, self.diffuse):
+            tz = table[i0]*(1 - w) + table[i1]*w
+            if wavelengths is not None:
+                j0, j1, v = _interp_axis(self.wavelengths, np.asarray(wavelengths, dtype=float))
+                tz = tz[:,j0]*(1 - v) + tz[:,j1]*v
+            out.append(tz)
+        return out[0], out[1]
+
+    def sample_sky(self, zenith, n, rng):
+        # Draws n diffuse sky directions for a sun at zenith angle zenith. Returns view
+        # zenith angles and azimuths relative to the sun; within a cell sin^2 of the view
+        # zenith is uniform, which matches the cos weighting of the irradiance
+        i0, i1, w = _interp_axis(self.zenith, float(zenith))
+        pdf = (self.sky_pdf[i0]*(1 - w) + self.sky_pdf[i1]*w).ravel()
+        cell = rng.choice(len(pdf), size=n, p=pdf/pdf.sum())
+        iv, ia = np.divmod(cell, len(self.azimuth_edges) - 1)
+        s0 = np.sin(self.view_edges[iv])**2
+        s1 = np.sin(self.view_edges[iv + 1])**2
+        view = np.arcsin(np.sqrt(s0 + rng.random(n)*(s1 - s0)))
+        azimuth = self.azimuth_edges[ia] + \
+            rng.random(n)*(self.azimuth_edges[ia + 1] - self.azimuth_edges[ia])
+        return view, azimuth
+
+
+def table_key(params):
+    blob = json.dumps({'version': TABLE_VERSION, **params}, sort_keys=True)
+    return hashlib.sha1(blob.encode()).hexdigest()[:16]
+
+
+def sky_tables(arg):
+    # SkyTables for arg['atmosphere'] (overrides of default_params). With
+    # arg['atmosphere_cache'] set they are computed once and stored as
+    # <atmosphere_cache>/sky_<key>.npz
+    params = {**default_params, **arg.get('atmosphere', {})}
+    cache = arg.get('atmosphere_cache')
+    if cache is None:
+        return SkyTables.compute(params=params)
+    path = os.path.join(cache, f'sky_{table_key(params)}.npz')
+    if os.path.exists(path):
+        return SkyTables.load(path)
+    tables = SkyTables.compute(params=params)
+    os.makedirs(cache, exist_ok=True)
+    tables.save(path)
+    return tables
+
+
+def sun_zenith(arg):
+    # The tracer sends sun photons along dir_vector(theta_sun + pi/2, phi_sun), i.e.
+    # theta_sun is the solar elevation; the tables use the zenith angle
+    return np.pi/2 - arg['theta_sun']
+
+
+def sky_source(arg, tables, n, rng, wavelengths = None):
+    # Directions and weights of n source photons under a clear sky. Each photon is direct
+    # sunlight with probability q, the direct share of the irradiance (broadband, or band
+    # averaged for spectral runs), otherwise it comes from a sky direction drawn from the
+    # tabulated radiance distribution. Spectral weights (n, nbands) are f/q or (1-f)/(1-q)
+    # with f the direct share of each band, so each band keeps its own direct/diffuse split.
+    # Also returns the mask of direct sun photons
+    zenith = sun_zenith(arg)
+    phi = arg['phi_sun']
+    direct, diffuse = tables.irradiance(zenith, wavelengths)
+    direct, diffuse = direct[0], diffuse[0]
+    with np.errstate(invalid='ignore'):
+        f = np.nan_to_num(direct/(direct + diffuse))
+    q = np.mean(f) if wavelengths is not None else direct.sum()/(direct + diffuse).sum()
+
+    is_direct = rng.random(n) < q
+    nd = np.count_nonzero(~is_direct)
+    view, azimuth = tables.sample_sky(zenith, nd, rng)
+    # sky direction (towards the sky) with azimuth measured from the sun, which lies at
+    # phi_sun + pi as seen from the scene; photons travel the opposite way
+    az = phi + np.pi + azimuth
+    direction = np.empty((n,3))
+    sun_dir = np.array([np.sin(zenith)*np.cos(phi), np.sin(zenith)*np.sin(phi),
+                        -np.cos(zenith)])
+    direction[is_direct] = sun_dir
+    direction[~is_direct] = -np.stack([np.sin(view)*np.cos(az), np.sin(view)*np.sin(az),
+                                       np.cos(view)], axis=1)
+
+    if wavelengths is None:
+        return direction, np.ones(n), is_direct
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(is_direct[:,None], f/q, (1 - f)/(1 - q))
+    return direction, np.nan_to_num(weight), is_direct
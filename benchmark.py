@@ -0,0 +1,193 @@
+# Benchmark suite for the batch tracer.
+#
+#   python benchmark.py                      run all cases, write bench.json
+#   python benchmark.py --quick              small cases only
+#   python benchmark.py --baseline old.json  also report regressions against a stored run
+#
+# Every case runs on fixed seeds and is timed over rounds of at least 0.2 s each.
+# Throughputs (photons/s, tests/s) should not drop and times/memory should not grow by
+# more than the tolerance of their metric (or --tolerance) relative to the baseline.
+
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+import tracemalloc
+import numpy as np
+
+import geometry
+import scene_conf
+import plantrt
+
+
+# (ntrees, nrows) of the orchards; the scene grows with the number of trees so that trees
+# keep their size
+SCENES = [(1,1), (2,2), (4,4), (8,8)]
+# (nscat, nplevels) for the tracer throughput
+ORDERS = [(5,0), (10,1), (20,4)]
+# leaf positions per shoot side (scene_conf.tbar_canopy) for the leaf density scaling, on
+# a 2x2 orchard
+DENSITY = [3, 6, 12]
+# (rays, leaves) and (rays, bboxes) for the intersection kernels
+KERNEL_LEAVES = [(1000, 100), (1000, 1000), (1000, 10000)]
+KERNEL_BBOXES = [(10000, 10), (10000, 100), (10000, 1000)]
+QUICK = 2 # number of cases of each kind with --quick
+
+NPHOTONS = 2000
+SEED = 1234
+
+# direction of each metric (+1 higher is better, -1 lower is better) and the relative
+# change allowed before it counts as a regression. Timings vary between runs on a busy
+# machine far more than the deterministic peak memory
+METRICS = {'photons_per_s': (1, 0.4), 'tests_per_s': (1, 0.4), 'build_s': (-1, 0.5),
+           'peak_mb': (-1, 0.1)}
+
+
+def _best(fn, repeat):
+    # best time per call over repeat rounds, each round calling fn as many times as it
+    # takes to last at least 0.2 s (timeit's autorange), and the result of one more call
+    timer = timeit.Timer(fn)
+    number = timer.autorange()[0]
+    return min(timer.repeat(repeat, number))/number, fn()
+
+
+def scene_arg(ntrees, nrows, nscat = 10, nplevels = 1, leaves_shoot_half = 3):
+    return {'theta_sun': np.pi*.3,
+            'phi_sun': np.pi/3.,
+            'nscat': nscat,
+            'nplevels': nplevels,
+            'nphotons': NPHOTONS,
+            'scene_extent': [200.*ntrees, 300.*nrows, 200.],
+            'ntrees': ntrees,
+            'nrows': nrows,
+            'leaves_shoot_half': leaves_shoot_half,
+            'seed': SEED,
+            'observer': {'center': [100.*ntrees, 150.*nrows, 150.],
+                         'extent': [200.*ntrees, 300.*nrows, 0],
+                         'normal': [0,0,-1]}}
+
+
+def bench_scene(ntrees, nrows, repeat = 5):
+    arg = scene_arg(ntrees, nrows)
+    tbuild, scene = _best(lambda: scene_conf.load_scene(arg), repeat)
+    return {'build_s': tbuild, 'nleaves': scene.nleaves, 'nbbox': len(scene.bounds)}
+
+
+def bench_trace(ntrees, nrows, nscat, nplevels, repeat = 5, leaves_shoot_half = 3):
+    arg = scene_arg(ntrees, nrows, nscat, nplevels, leaves_shoot_half)
+    scene = scene_conf.load_scene(arg)
+    ttrace, out = _best(lambda: plantrt.trace(arg, scene, np.random.default_rng(SEED)), repeat)
+
+    tracemalloc.start()
+    plantrt.trace(arg, scene, np.random.default_rng(SEED))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'photons_per_s': NPHOTONS/ttrace, 'nphotons': out[0], 'peak_mb': peak/2**20,
+            'nleaves': scene.nleaves}
+
+
+def _random_disks(rng, m):
+    center = rng.uniform(0, 100, (m,3))
+    normal = rng.normal(size=(m,3))
+    normal /= np.linalg.norm(normal, axis=1)[:,None]
+    radius = rng.uniform(1, 5, m)
+    return center, normal, radius
+
+
+def bench_raydisk(nrays, nleaves, repeat = 5):
+    rng = np.random.default_rng(SEED)
+    center, normal, radius = _random_disks(rng, nleaves)
+    const = geometry.disk_constants(normal, center, radius)
+    pos = rng.uniform(0, 100, (nrays,3))
+    direction = rng.normal(size=(nrays,3))
+    direction /= np.linalg.norm(direction, axis=1)[:,None]
+    t, out = _best(lambda: geometry.do_raydisk_batch(pos, direction, normal, center, const),
+                   repeat)
+    return {'tests_per_s': nrays*nleaves/t}
+
+
+def bench_raybox(nrays, nbb, repeat = 5):
+    rng = np.random.default_rng(SEED)
+    lo = rng.uniform(0, 100, (nbb,3))
+    bounds = np.stack([lo, lo + rng.uniform(1, 20, (nbb,3))], axis=1)
+    pos = rng.uniform(0, 100, (nrays,3))
+    direction = rng.normal(size=(nrays,3))
+    invdir = 1./direction
+    t, out = _best(lambda: geometry.raybox_interval(pos, invdir, bounds), repeat)
+    return {'tests_per_s': nrays*nbb/t}
+
+
+def run_suite(quick = False):
+    n = QUICK if quick else None
+    results = {}
+    for ntrees, nrows in SCENES[:n]:
+        results[f'scene_{ntrees}x{nrows}'] = bench_scene(ntrees, nrows)
+        for nscat, nplevels in ORDERS[:n]:
+            results[f'trace_{ntrees}x{nrows}_s{nscat}_p{nplevels}'] = \
+                bench_trace(ntrees, nrows, nscat, nplevels)
+    for half in DENSITY[:n]:
+        results[f'trace_2x2_l{half}'] = bench_trace(2, 2, 10, 1, leaves_shoot_half=half)
+    for nrays, nleaves in KERNEL_LEAVES[:n]:
+        results[f'raydisk_{nrays}x{nleaves}'] = bench_raydisk(nrays, nleaves)
+    for nrays, nbb in KERNEL_BBOXES[:n]:
+        results[f'raybox_{nrays}x{nbb}'] = bench_raybox(nrays, nbb)
+
+    meta = {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'quick': quick}
+    return {'meta': meta, 'results': results}
+
+
+def compare(current, baseline, tolerance = None):
+    # Returns a list of (case, metric, baseline, current) that regressed by more than
+    # tolerance, the tolerance of each metric in METRICS if None. Cases or metrics missing
+    # from either side are ignored
+    regressions = []
+    for case, res in current['results'].items():
+        base = baseline['results'].get(case)
+        if base is None:
+            continue
+        for metric, (sense, tol) in METRICS.items():
+            if metric not in res or metric not in base:
+                continue
+            tol = tol if tolerance is None else tolerance
+            if sense > 0 and res[metric] < base[metric]*(1 - tol):
+                regressions.append((case, metric, base[metric], res[metric]))
+            if sense < 0 and res[metric] > base[metric]*(1 + tol):
+                regressions.append((case, metric, base[metric], res[metric]))
+    return regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='plantrt benchmarks')
+    parser.add_argument('--quick', action='store_true', help='small cases only')
+    parser.add_argument('--out', default='bench.json', help='output JSON file')
+    parser.add_argument('--baseline', help='stored JSON results to compare against')
+    parser.add_argument('--tolerance', type=float,
+                        help='allowed relative regression for every metric (default: per '
+                             'metric, see METRICS)')
+    args = parser.parse_args(argv)
+
+    current = run_suite(args.quick)
+    with open(args.out, 'w') as f:
+        json.dump(current, f, indent=1)
+
+    for case, res in current['results'].items():
+        print(case, ', '.join(f'{k}={v:.4g}' for k, v in res.items()))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.tolerance)
+        for case, metric, old, new in regressions:
+            print(f'REGRESSION {case} {metric}: {old:.4g} -> {new:.4g}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
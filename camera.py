@@ -0,0 +1,115 @@
+# Backward-tracing camera on the observer plane.
+# The observer dict (center, extent, normal) is treated as an orthographic sensor looking
+# along its normal, with a pixel grid spanning its extent along the two axes other than the
+# dominant axis of the normal (the same image layout as tally.Tallies.image). Primary rays
+# are generated per tile of pixels and shaded with direct sun, a shadow ray and diffuse sky
+# light; tiles are independent, so plantrt.Simulation.render spreads them over workers.
+# Primary and shadow rays go through the side walls of the scene as the tracer's photons
+# do (sunlit.cast), so tiled scenes look like the block they stand for.
+#
+# Shading assumes Lambertian leaves and soil: specular leaves, as used by the forward
+# tracer, would only ever show the sun's glint in an orthographic view. Turbid bboxes
+# (CompiledScene.set_lod) are not rendered.
+
+import numpy as np
+import atmosphere
+import sunlit
+
+
+def tiles(shape, tile = 64):
+    # (r0, r1, c0, c1) pixel ranges covering an image of the given shape
+    return [(r0, min(r0 + tile, shape[0]), c0, min(c0 + tile, shape[1]))
+            for r0 in range(0, shape[0], tile) for c0 in range(0, shape[1], tile)]
+
+
+def primary_rays(observer, shape, tile, spp, rng):
+    # Ray origins on the observer plane and the common direction for the pixels of tile,
+    # spp jittered samples per pixel (one at the pixel centre if spp is 1). Origins are
+    # ordered pixel by pixel, samples of a pixel being contiguous
+    center = np.asarray(observer['center'], dtype=float)
+    normal = np.asarray(observer['normal'], dtype=float)
+    normal = normal/np.linalg.norm(normal)
+    axis = int(np.argmax(np.abs(normal)))
+    uv = [x for x in range(3) if x != axis]
+    extent = np.asarray(observer['extent'], dtype=float)[uv]
+
+    r0, r1, c0, c1 = tile
+    ii, jj = np.meshgrid(np.arange(r0, r1), np.arange(c0, c1), indexing='ij')
+    ii = np.repeat(ii.ravel(), spp)
+    jj = np.repeat(jj.ravel(), spp)
+    if spp == 1:
+        du = dv = np.full(len(ii), 0.5)
+    else:
+        du, dv = rng.random(len(ii)), rng.random(len(ii))
+
+    pos = np.tile(center, (len(ii), 1))
+    pos[:,uv[0]] += ((ii + du)/shape[0] - 0.5)*extent[0]
+    pos[:,uv[1]] += ((jj + dv)/shape[1] - 0.5)*extent[1]
+    return pos, normal
+
+
+def illumination(arg, materials = None):
+    # Sun direction (towards the sun), direct irradiance on a surface facing the sun and
+    # diffuse irradiance. From the clear-sky tables if arg['sky'] is set (per band in
+    # spectral runs), otherwise 1 and arg['camera_ambient'] (default 0.2)
+    sun = sunlit.sun_direction(arg['theta_sun'], arg['phi_sun'])
+    if not arg.get('sky', False):
+        return sun, 1., arg.get('camera_ambient', 0.2)
+    tables = atmosphere.sky_tables(arg)
+    zenith = atmosphere.sun_zenith(arg)
+    wavelengths = None if materials is None else materials.wavelengths
+    direct, diffuse = tables.irradiance(zenith, wavelengths)
+    direct, diffuse = direct[0], diffuse[0]
+    if wavelengths is None: # broadband
+        direct, diffuse = direct.sum(), diffuse.sum()
+    return sun, direct/max(np.cos(zenith), 1e-6), diffuse
+
+
+def shade(scene, arg, pos, direction, materials = None, light = None):
+    # Radiance seen along each primary ray: rho/pi*(E_sun*cos*visible + E_diffuse) at the
+    # first leaf, or at the ground if no leaf is hit (0 for rays leaving through the top).
+    # Reflectances are the material spectra in spectral runs, otherwise
+    # arg['rho_leaf'] (0.1) and arg['soil_albedo'] (0.2)
+    scene_extent = np.asarray(arg['scene_extent'], dtype=float)
+    sun, e_sun, e_diff = illumination(arg, materials) if light is None else light
+    n = len(pos)
+    periodic = sunlit.periodic_axes(arg)
+    idl, p, d, axis = sunlit.cast(scene, pos, direction, scene_extent, periodic=periodic)
+    leaf = idl >= 0
+    ground = ~leaf & (axis == 2) & (d[:,2] < 0)
+    k = np.flatnonzero(leaf | ground)
+    leaf, idl, p = leaf[k], idl[k], p[k]
+
+    # rays mirrored off side walls see the mirror image of the scene, lit by the mirror
+    # image of the sun
+    sun = np.where(d[k]*np.asarray(direction, dtype=float) < 0, -1., 1.)*sun
+    normal = np.tile([0., 0., 1.], (len(k), 1))
+    normal[leaf] = scene.leaf_normal(idl[leaf])
+    cos = np.maximum(np.sum(normal*sun, axis=1), 0)
+
+    # shadow rays towards the sun, blocked by leaves seen from either side
+    visible = sunlit.visible(scene, p, sun, scene_extent, skip=np.where(leaf, idl, -1),
+                             periodic=periodic)
+
+    if materials is None:
+        rho = np.where(leaf, arg.get('rho_leaf', 0.1), arg.get('soil_albedo', 0.2))
+        out = np.zeros(n)
+    else:
+        soil = materials.index(arg.get('soil_material', 'soil'))
+        mat = np.full(len(k), soil)
+        mat[leaf] = scene.leaf_material(idl[leaf])
+        rho = materials.rho[mat]
+        out = np.zeros((n, materials.nbands))
+    lit = (cos*visible).reshape((-1,) + (1,)*(out.ndim - 1))
+    out[k] = rho/np.pi*(np.asarray(e_sun)*lit + np.asarray(e_diff))
+    return out
+
+
+def render_tile(arg, scene, observer, tile, shape, spp = 1, rng = None, materials = None):
+    # Image of one tile, (r1-r0, c1-c0) or (r1-r0, c1-c0, nbands)
+    if rng is None:
+        rng = np.random.default_rng()
+    pos, direction = primary_rays(observer, shape, tile, spp, rng)
+    val = shade(scene, arg, pos, direction, materials)
+    r0, r1, c0, c1 = tile
+    return val.reshape((r1 - r0, c1 - c0, spp) + val.shape[1:]).mean(axis=2)
@@ -14,7 +14,7 @@ def get_normal_aabb(p,bounds):
     normal = np.zeros(3,dtype=int)
     normal[ic] = 1
     dd = p.dir.dot(normal)
-    logging.debug(f'normal calculation: pos {p.pos}, normal {normal}, dd {dd}')
+    logging.debug('normal calculation: pos %s, normal %s, dd %s', p.pos, normal, dd)
     if dd >0:
         normal[ic] = -1
 
@@ -58,6 +58,13 @@ def specular_reflection(incident, normal):
     return out/np.linalg.norm(out)
 
 
+def specular_reflection_batch(incident, normal):
+    # Same as specular_reflection for arrays of shape (n,3)
+    ndot = np.einsum('ij,ij->i', incident, normal)
+    out = incident - 2*ndot[:,None]*normal
+    return out/np.linalg.norm(out, axis=1)[:,None]
+
+
 
 def get_rayplaneintersect(planeNormal, planePoint, rayDirection, rayPoint, epsilon=1e-6):
 
@@ -86,7 +93,7 @@ def do_raydisk(normal, centre, radius, raydir, raypoint, epsilon=1e-6):
     else:
         t = tpsi[0][0]
         psi = tpsi[1][0]
-        dd = np.linalg.norm(psi - raypoint)
+        dd = np.sum((psi - centre)**2)
 
         if dd <= radius**2:
             return t
@@ -94,6 +101,101 @@ def do_raydisk(normal, centre, radius, raydir, raypoint, epsilon=1e-6):
             return -1
 
 
+def disk_constants(normal, centre, radius):
+    # Per-disk constants used by do_raydisk_batch: plane offset n.c, squared radius and |c|^2
+    normal = np.asarray(normal, dtype=float)
+    centre = np.asarray(centre, dtype=float)
+    radius = np.asarray(radius, dtype=float)
+    return {'d' : np.einsum('ij,ij->i', normal, centre),
+            'r2': radius**2,
+            'cc': np.einsum('ij,ij->i', centre, centre)}
+
+
+def do_raydisk_batch(raypoint, raydir, normal, centre, const, skip=None, tol=1e-6,
+                     one_sided=True, chunk=1<<22):
+    # Nearest intersection between each ray and an array of disks in a single pass.
+    # raypoint, raydir: (3,) or (n,3). normal, centre: (m,3). const from disk_constants.
+    # skip: optional (n,) disk index ignored for each ray (-1 for none).
+    # Returns distance (inf if no hit) and disk index (-1 if no hit) per ray.
+    # As in get_rayplaneintersect, one-sided disks are only hit from the side the normal
+    # points to. |psi - c|^2 is expanded so that no (n,m,3) temporaries are needed
+    single = np.ndim(raypoint) == 1
+    raypoint = np.atleast_2d(raypoint)
+    raydir = np.atleast_2d(raydir)
+    n, m = len(raypoint), len(centre)
+    t_best = np.full(n, np.inf)
+    id_best = np.full(n, -1, dtype=np.int64)
+    if m == 0 or n == 0:
+        return (t_best[0], id_best[0]) if single else (t_best, id_best)
+
+    step = max(1, chunk//m)
+    for i0 in range(0, n, step):
+        o = raypoint[i0:i0+step]
+        u = raydir[i0:i0+step]
+        ndotu = u @ normal.T
+        ndoto = o @ normal.T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (const['d'][None,:] - ndoto)/ndotu
+
+        # |o + t u - c|^2
+        ou = np.einsum('ij,ij->i', o, u)
+        oo = np.einsum('ij,ij->i', o, o)
+        uu = np.einsum('ij,ij->i', u, u)
+        oc = o @ centre.T
+        uc = u @ centre.T
+        dd = oo[:,None] - 2*oc + const['cc'][None,:] + 2*t*(ou[:,None] - uc) + t*t*uu[:,None]
+
+        facing = ndotu < -tol if one_sided else np.abs(ndotu) > tol
+        hit = facing & (t > tol) & (dd <= const['r2'][None,:])
+        if skip is not None:
+            hit &= np.arange(m)[None,:] != np.atleast_1d(skip)[i0:i0+step,None]
+        t = np.where(hit, t, np.inf)
+
+        il = np.argmin(t, axis=1)
+        tl = t[np.arange(len(o)), il]
+        found = np.isfinite(tl)
+        t_best[i0:i0+step] = tl
+        id_best[i0:i0+step] = np.where(found, il, -1)
+
+    if single:
+        return t_best[0], id_best[0]
+    return t_best, id_best
+
+
+def do_raydisk_pairs(raypoint, raydir, normal, centre, const, tol=1e-6, one_sided=True):
+    # Row-by-row version of do_raydisk_batch: ray i against disk i, all arrays (k,3)/(k,).
+    # Returns the distance to each disk, inf where the ray misses it
+    ndotu = np.einsum('ij,ij->i', raydir, normal)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (const['d'] - np.einsum('ij,ij->i', raypoint, normal))/ndotu
+    w = raypoint + t[:,None]*raydir - centre
+    dd = np.einsum('ij,ij->i', w, w)
+
+    facing = ndotu < -tol if one_sided else np.abs(ndotu) > tol
+    hit = facing & (t > tol) & (dd <= const['r2'])
+    return np.where(hit, t, np.inf)
+
+
+def disk_aabb(normal, centre, radius):
+    # Tight axis-aligned box of a disk: half-size along axis i is r*sqrt(1 - n_i^2)
+    normal = np.asarray(normal, dtype=float)
+    nn = normal/np.linalg.norm(normal, axis=1)[:,None]
+    half = np.asarray(radius, dtype=float)[:,None]*np.sqrt(np.clip(1 - nn**2, 0, 1))
+    return centre - half, centre + half
+
+
+def disk_basis(normal):
+    # Two unit vectors u, v (m, 3) perpendicular to each normal and to each other, spanning
+    # the plane of each disk
+    normal = np.asarray(normal, dtype=float)
+    normal = normal/np.linalg.norm(normal, axis=1)[:,None]
+    # any axis not parallel to the normal gives the first in-plane vector
+    helper = np.where(np.abs(normal[:,:1]) < 0.9, [[1.,0,0]], [[0,1.,0]])
+    u = np.cross(normal, helper)
+    u /= np.linalg.norm(u, axis=1)[:,None]
+    return u, np.cross(normal, u)
+
+
 
 
 
@@ -142,6 +244,66 @@ def do_raybox(r, bounds, tol = 1e-4):
     return t
 
 
+def wall_distance(raypoint, invdir, scene_extent):
+    # Distance from points inside the scene box (0, scene_extent) to the wall each ray
+    # leaves through, and the axis of that wall
+    far = np.where(invdir > 0, np.asarray(scene_extent, dtype=float), 0.)
+    with np.errstate(invalid='ignore'):
+        t = (far - raypoint)*invdir
+    t = np.where(np.isnan(t) | (t < 0), np.inf, t)
+    axis = np.argmin(t, axis=1)
+    return t[np.arange(len(t)), axis], axis
+
+
+def raybox_interval(raypoint, invdir, bounds, chunk=1<<22):
+    # Slab test of rays against many axis-aligned boxes at once.
+    # raypoint, invdir: (3,) or (n,3); bounds: (nbb,2,3) array of [min, max] corners.
+    # Returns tmin, tmax of shape (n,nbb) (or (nbb,) for a single ray); the ray hits
+    # box j if tmax >= max(tmin, 0). Inputs are never modified
+    single = np.ndim(raypoint) == 1
+    raypoint = np.atleast_2d(raypoint)
+    invdir = np.atleast_2d(invdir)
+    bounds = np.asarray(bounds, dtype=float)
+    n, nbb = len(raypoint), len(bounds)
+    tmin = np.empty((n, nbb))
+    tmax = np.empty((n, nbb))
+
+    step = max(1, chunk//max(nbb, 1))
+    for i0 in range(0, n, step):
+        o = raypoint[i0:i0+step]
+        inv = invdir[i0:i0+step]
+        lo = np.full((len(o), nbb), -np.inf)
+        hi = np.full((len(o), nbb), np.inf)
+        # one axis at a time on (n,nbb) arrays, much faster than reducing a trailing
+        # axis of 3. nan (0*inf) only appears for rays parallel to a slab and lying on its
+        # plane; fmin/fmax then treat that axis as unconstrained
+        for a in range(3):
+            with np.errstate(invalid='ignore'):
+                t1 = (bounds[None,:,0,a] - o[:,None,a])*inv[:,None,a]
+                t2 = (bounds[None,:,1,a] - o[:,None,a])*inv[:,None,a]
+            lo = np.fmax(lo, np.fmin(t1, t2))
+            hi = np.fmin(hi, np.fmax(t1, t2))
+        tmin[i0:i0+step] = lo
+        tmax[i0:i0+step] = hi
+
+    if single:
+        return tmin[0], tmax[0]
+    return tmin, tmax
+
+
+def do_raybox_batch(raypoint, invdir, bounds, skip=None):
+    # Batched do_raybox: distance to every box for every ray, (n,nbb) or (nbb,).
+    # As in do_raybox this is the entry distance, or the exit distance for rays starting
+    # inside the box. Misses, and boxes flagged in the optional (nbb,) bool mask skip,
+    # get inf so that np.argmin picks the closest box hit
+    tmin, tmax = raybox_interval(raypoint, invdir, bounds)
+    t = np.where(tmin > 0, tmin, tmax)
+    t = np.where((tmax >= np.maximum(tmin, 0)), t, np.inf)
+    if skip is not None:
+        t = np.where(skip, np.inf, t)
+    return t
+
+
 
 
 
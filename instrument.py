@@ -0,0 +1,70 @@
+# Optional counters and phase timers for the tracer.
+# Everything is off unless enable() is called. Hot paths guard counter updates with
+# `if instrument.enabled:` and phase() hands back a shared null context when disabled, so a
+# disabled run pays one attribute lookup per call site and nothing per photon.
+
+import time
+import contextlib
+
+enabled = False
+counters = {}
+timers = {}
+
+_null = contextlib.nullcontext()
+
+
+def enable(on = True):
+    global enabled
+    enabled = on
+
+
+def reset():
+    counters.clear()
+    timers.clear()
+
+
+def count(name, n = 1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + int(n)
+
+
+class _Phase:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        calls, total = timers.get(self.name, (0, 0.))
+        timers[self.name] = (calls + 1, total + time.perf_counter() - self.t0)
+        return False
+
+
+def phase(name):
+    # with instrument.phase('leaf_search'): ...
+    return _Phase(name) if enabled else _null
+
+
+def report():
+    # Structured snapshot of counters and timers
+    return {'counters': dict(counters),
+            'timers': {k: {'calls': c, 'total_s': t} for k, (c, t) in timers.items()}}
+
+
+def merge(rep):
+    # Adds a report (e.g. from a worker process) to the current counters and timers
+    for k, v in rep['counters'].items():
+        counters[k] = counters.get(k, 0) + v
+    for k, v in rep['timers'].items():
+        calls, total = timers.get(k, (0, 0.))
+        timers[k] = (calls + v['calls'], total + v['total_s'])
+
+
+def format_report(rep = None):
+    rep = report() if rep is None else rep
+    lines = [f'{k:>24s} {v}' for k, v in sorted(rep['counters'].items())]
+    lines += [f'{k:>24s} {v["total_s"]:.4f} s ({v["calls"]} calls)'
+              for k, v in sorted(rep['timers'].items(), key=lambda x: -x[1]['total_s'])]
+    return '\n'.join(lines)
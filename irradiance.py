@@ -0,0 +1,207 @@
+# Per-leaf irradiance cache.
+# Light-interception queries (sunlit leaf fraction, absorbed PAR per leaf or per cane) only
+# need the flux reaching every leaf, which is the same each time for a given scene and
+# sun/sky configuration. LeafIrradiance keeps it as arrays aligned with the leaf index of
+# the scene, split into direct (unscattered sunlight) and diffuse (sky light and light
+# scattered by leaves or the ground) parts, and IrradianceCache keeps the most recently
+# used ones in memory and, optionally, on disk.
+#
+#   irr = irradiance.leaf_irradiance(arg, scene)   # traced once, then served from cache
+#   irr.sunlit_fraction(), irr.absorbed_by('cane')
+#
+# Irradiances are relative to the horizontal irradiance above the canopy (per band in
+# spectral runs): multiply by the irradiance of atmosphere.SkyTables for W/m2.
+
+import os
+import json
+import hashlib
+import collections
+import numpy as np
+import plantrt
+
+# Bumped whenever the tracer or the stored arrays change meaning, so that stale cache
+# entries are never reused
+IRRADIANCE_VERSION = 3
+
+# run parameters that change the light reaching the leaves. The seed is left out: runs
+# differing only by their seed estimate the same irradiance
+LIGHT_KEYS = ('theta_sun', 'phi_sun', 'sky', 'atmosphere', 'wavelengths', 'materials',
+              'scene_extent', 'observer', 'nphotons', 'nscat', 'nplevels', 'weighted',
+              'rho_leaf', 'tau_leaf', 'leaf_absorptance', 'soil_material', 'periodic',
+              'max_walls', 'open_top', 'rr_threshold', 'rr_survival', 'split_threshold')
+
+
+class LeafIrradiance:
+    # direct, diffuse, absorbed: (nleaves,) or (nleaves, nbands) irradiance on the side of
+    # each leaf facing the light and irradiance absorbed, per unit leaf area. area is the
+    # one-sided leaf area (0 for removed leaves). tree, cane: the tree and cane of every
+    # leaf (-1 if unknown)
+    arrays = ('direct', 'diffuse', 'absorbed', 'area', 'tree', 'cane')
+
+    def __init__(self, direct, diffuse, absorbed, area, tree = None, cane = None,
+                 nsource = 0, key = None):
+        self.direct = np.asarray(direct, dtype=float)
+        self.diffuse = np.asarray(diffuse, dtype=float)
+        self.absorbed = np.asarray(absorbed, dtype=float)
+        self.area = np.asarray(area, dtype=float)
+        unknown = np.full(len(self.area), -1, dtype=np.int64)
+        self.tree = unknown if tree is None else np.asarray(tree, dtype=np.int64)
+        self.cane = unknown if cane is None else np.asarray(cane, dtype=np.int64)
+        self.nsource = nsource
+        self.key = key
+
+    @property
+    def nleaves(self):
+        return len(self.area)
+
+    @property
+    def total(self):
+        return self.direct + self.diffuse
+
+    @classmethod
+    def from_tallies(cls, tallies, scene, key = None):
+        # Source photons are spread over the observer footprint, so each carries
+        # footprint_area/nsource of the horizontal irradiance
+        idl = np.arange(scene.nleaves)
+        area = np.pi*scene.leaf_radius(idl)**2
+        power = np.prod(tallies.obs_extent)/max(tallies.nsource, 1)
+        scale = np.divide(power, area, out=np.zeros_like(area), where=area > 0)
+        if tallies.nbands:
+            scale = scale[:,None]
+        return cls(tallies.leaf_direct*scale, (tallies.leaf_flux - tallies.leaf_direct)*scale,
+                   tallies.leaf_absorbed*scale, area, scene.leaf_tree(idl),
+                   scene.leaf_cane(idl), tallies.nsource, key)
+
+    def sunlit_fraction(self, threshold = 0.):
+        # Fraction of the leaf area whose direct irradiance (band mean in spectral runs)
+        # exceeds threshold
+        direct = self.direct.mean(axis=1) if self.direct.ndim == 2 else self.direct
+        return self.area[direct > threshold].sum()/max(self.area.sum(), 1e-300)
+
+    def absorbed_by(self, labels, n = None):
+        # Absorbed power (irradiance times leaf area) summed over leaves with the same
+        # label: 'cane', 'tree' or a label per leaf; labels < 0 are ignored
+        if isinstance(labels, str):
+            if labels not in ('tree', 'cane'):
+                raise ValueError(f"labels must be 'tree', 'cane' or an array, not {labels!r}")
+            labels = getattr(self, labels)
+        labels = np.asarray(labels, dtype=np.int64)
+        keep = labels >= 0
+        power = self.absorbed*(self.area if self.absorbed.ndim == 1 else self.area[:,None])
+        n = labels.max(initial=-1) + 1 if n is None else n
+        if power.ndim == 1:
+            return np.bincount(labels[keep], weights=power[keep], minlength=n)
+        return np.stack([np.bincount(labels[keep], weights=p[keep], minlength=n)
+                         for p in power.T], axis=1)
+
+    def save(self, path):
+        np.savez(path, version=IRRADIANCE_VERSION, nsource=self.nsource, key=str(self.key),
+                 **{k: getattr(self, k) for k in self.arrays})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            if int(f['version']) != IRRADIANCE_VERSION:
+                raise ValueError(f'{path}: irradiance version {int(f["version"])}, '
+                                 f'expected {IRRADIANCE_VERSION}')
+            return cls(*(f[k] for k in cls.arrays), nsource=int(f['nsource']),
+                       key=str(f['key']))
+
+
+class IrradianceCache:
+    # LRU cache of LeafIrradiance by key, holding at most maxsize entries in memory. With
+    # a path, entries are also written to <path>/irr_<key>.npz and read back on a memory
+    # miss, so they survive evictions and outlive the process
+    def __init__(self, maxsize = 16, path = None):
+        self.maxsize = maxsize
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _file(self, key):
+        return os.path.join(self.path, f'irr_{key}.npz')
+
+    def get(self, key):
+        # The cached LeafIrradiance, or None
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        if self.path is not None and os.path.exists(self._file(key)):
+            irr = LeafIrradiance.load(self._file(key))
+            self._remember(key, irr)
+            self.hits += 1
+            return irr
+        self.misses += 1
+        return None
+
+    def put(self, key, irr):
+        self._remember(key, irr)
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+            # written under a temporary name first so readers never see partial files
+            tmp = self._file(key) + '.tmp.npz'
+            irr.save(tmp)
+            os.replace(tmp, self._file(key))
+
+    def _remember(self, key, irr):
+        self.entries[key] = irr
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        # Empties the memory cache; files on disk are kept
+        self.entries.clear()
+
+
+def _jsonable(x):
+    if isinstance(x, dict):
+        return {k: _jsonable(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple, np.ndarray)):
+        return [_jsonable(v) for v in x]
+    if isinstance(x, np.generic):
+        return x.item()
+    if hasattr(x, 'rho') and hasattr(x, 'tau'): # pdf.Materials
+        return {'wavelengths': _jsonable(x.wavelengths), 'names': x.names,
+                'rho': _jsonable(x.rho), 'tau': _jsonable(x.tau)}
+    return x
+
+
+def irradiance_key(arg, scene):
+    # Cache key from the scene contents and the light configuration of arg
+    params = {k: _jsonable(arg[k]) for k in LIGHT_KEYS if arg.get(k) is not None}
+    blob = json.dumps({'version': IRRADIANCE_VERSION, 'scene': scene.content_hash(),
+                       **params}, sort_keys=True)
+    return hashlib.sha1(blob.encode()).hexdigest()[:16]
+
+
+# one memory cache per disk location (None for memory only)
+_caches = {}
+
+def cache_for(arg):
+    # Shared IrradianceCache persisted under arg['irradiance_cache'] (memory only if
+    # unset), holding arg['irradiance_cache_size'] (default 16) entries
+    path = arg.get('irradiance_cache')
+    if path not in _caches:
+        _caches[path] = IrradianceCache(arg.get('irradiance_cache_size', 16), path)
+    return _caches[path]
+
+
+def leaf_irradiance(arg, scene = None, cache = None):
+    # LeafIrradiance of scene (built from arg if None, as by plantrt.run_batch) under the
+    # sun/sky configuration of arg, from cache (cache_for(arg) by default) or traced with
+    # plantrt.run_batch and added to it
+    scene = plantrt.compiled_scene(arg, scene)
+    cache = cache_for(arg) if cache is None else cache
+    key = irradiance_key(arg, scene)
+    irr = cache.get(key)
+    if irr is None:
+        tallies = plantrt.run_batch(arg, scene=scene)[3]
+        irr = LeafIrradiance.from_tallies(tallies, scene, key)
+        cache.put(key, irr)
+    return irr
@@ -1,7 +1,76 @@
-# Module to deal with all different interactions between 
+# Module to deal with all different interactions between
 # photons and surfaces
 
+import numpy as np
 
-def  
 
+class Materials:
+    # Optical properties of the scene materials on a common set of wavelengths (nm).
+    # rho and tau are (nmat, nbands) reflectance and transmittance spectra; row m is
+    # material id m, as stored per leaf in the compiled scene (0 unless set)
+    def __init__(self, wavelengths, names, rho, tau):
+        self.wavelengths = np.asarray(wavelengths, dtype=float)
+        self.names = list(names)
+        self.rho = np.atleast_2d(np.asarray(rho, dtype=float))
+        self.tau = np.atleast_2d(np.asarray(tau, dtype=float))
+        if self.rho.shape != (len(self.names), len(self.wavelengths)) or \
+                self.tau.shape != self.rho.shape:
+            raise ValueError('rho and tau must be (nmaterials, nwavelengths) arrays')
+        if np.any(self.rho + self.tau > 1):
+            raise ValueError('rho + tau must not exceed 1')
 
+    @property
+    def nbands(self):
+        return len(self.wavelengths)
+
+    def index(self, name):
+        return self.names.index(name)
+
+    def optics(self, material):
+        # Reflectance and transmittance spectra of an array of material ids, (k,nbands) each
+        return self.rho[material], self.tau[material]
+
+    @classmethod
+    def from_spectra(cls, wavelengths, spectra):
+        # spectra: {name: (wl, rho, tau)} sampled on any wavelength grid, linearly
+        # interpolated to wavelengths (tau may be None for opaque materials)
+        rho = []
+        tau = []
+        for name, (wl, r, t) in spectra.items():
+            rho.append(np.interp(wavelengths, wl, r))
+            tau.append(np.zeros(len(wavelengths)) if t is None else np.interp(wavelengths, wl, t))
+        return cls(wavelengths, list(spectra), rho, tau)
+
+
+def leaf_spectrum(wavelengths):
+    # Rough green leaf: low reflectance in the visible with a bump at 550 nm, a red edge
+    # around 715 nm and a high near-infrared plateau; transmittance follows reflectance
+    wl = np.asarray(wavelengths, dtype=float)
+    edge = 1/(1 + np.exp(-(wl - 715.)/15.))
+    rho = 0.05 + 0.07*np.exp(-((wl - 550.)/35.)**2) + 0.40*edge
+    tau = 0.02 + 0.04*np.exp(-((wl - 550.)/35.)**2) + 0.40*edge
+    return rho, tau
+
+
+def soil_spectrum(wavelengths):
+    # Rough bare soil: opaque, reflectance rising slowly with wavelength
+    wl = np.asarray(wavelengths, dtype=float)
+    rho = np.clip(0.08 + 0.25*(wl - 400.)/1100., 0.05, 0.4)
+    return rho, np.zeros_like(rho)
+
+
+def default_materials(wavelengths):
+    # 'leaf' (material id 0, the default for every leaf) and 'soil'
+    rl, tl = leaf_spectrum(wavelengths)
+    rs, ts = soil_spectrum(wavelengths)
+    return Materials(wavelengths, ['leaf', 'soil'], [rl, rs], [tl, ts])
+
+
+def materials_for(arg):
+    # Materials of a run: arg['materials'] if given, default_materials on
+    # arg['wavelengths'] if only those are given, None for a monochromatic run
+    if arg.get('materials') is not None:
+        return arg['materials']
+    if arg.get('wavelengths') is not None:
+        return default_materials(arg['wavelengths'])
+    return None
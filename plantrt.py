@@ -1,6 +1,17 @@
+import os
+import time
+import pickle
+import multiprocessing
 import numpy as np
 import scene_conf
 import geometry
+import tally
+import pdf
+import atmosphere
+import trajectory
+import camera
+import sunlit
+import instrument
 import logging
 
 class Photon:
@@ -24,6 +35,12 @@ class Photon:
         self.sign[2] = 1 if self.invdir[2] < 0 else 0
         
 
+default_observer = {'name'  : 'observer',
+                    'center': [99, 50, 90],
+                    'extent': [5,5, 0],
+                    'normal': [0,0,-1]} # looking downwards
+
+
 class RayBundle:
     def __init__(self):
         self.photon = [Photon()]
@@ -36,74 +53,50 @@ class RayBundle:
 
 
 def next_interaction_bbox(p,scene,nbb, tol = 1e-6,skip_id = [-1]):
-    # find next surface. Loop around nbb bounding boxes and nbs boundaries
-    r = []
-    ids = []
-    p_int = []
-    poi = p.pos
-    #norep = p.medium if p.medium > 0 else -1
-
-    for ibb in range(nbb):
-        pp = geometry.do_raybox(p, scene.bbox.bounds[ibb])
-        logging.debug('%s, pp=%g'%(scene.bbox.name[ibb], pp))
-        #if pp > tol and ibb != skip_id and ibb != norep:
-        if ibb not in skip_id:
-            p_int.append([pp])
-            ids.append(ibb)
-            
-    if p_int == []:
-        return poi, -1
+    # find next surface: closest of the first nbb bounding boxes hit by the photon,
+    # all boxes tested in a single slab test. Boxes in skip_id are ignored
+    bounds = np.asarray(scene.bbox.bounds[:nbb], dtype=float)
+    skip = np.zeros(nbb, dtype=bool)
+    skip[[i for i in skip_id if 0 <= i < nbb]] = True
+
+    pp = geometry.do_raybox_batch(p.pos, p.invdir, bounds, skip=skip)
+    idcol = np.argmin(pp)
+    if not np.isfinite(pp[idcol]):
+        return p.pos, -1
 
-    pmin = np.argmin(p_int)
-    pval = p_int[pmin]
-    idcol = ids[pmin]
-    poi += p_int[pmin]*p.dir
+    poi = p.pos + pp[idcol]*p.dir
     return poi, idcol
 
 def next_interaction_canopy(p,scene,ibb, tol = 1e-6,skip_id = [-1,-1]):
-    # find next surface. Loop around nbb bounding boxes and nbs boundaries
-    r = []
-    ids = []
-    p_int = []
-    
+    # find next surface: closest leaf within bbox ibb, all leaves tested in a single pass
     leaf = scene.bbox.leaf[ibb]
-    nleaves = len(leaf['center'])
+    if len(leaf) == 0 or len(leaf['center']) == 0:
+        return p.pos, -1
 
-    for il in range(nleaves):
-        
-        pp = geometry.do_raydisk(leaf['normal'][il], leaf['center'][il], 
-                leaf['radius'][il], p.dir, p.pos)
+    if 'const' not in leaf: # plane constants are computed once per leaf set
+        leaf['const'] = geometry.disk_constants(leaf['normal'], leaf['center'], leaf['radius'])
+    normal = np.asarray(leaf['normal'], dtype=float)
+    center = np.asarray(leaf['center'], dtype=float)
 
-        if pp > tol and ibb != skip_id[0] and il != skip_id[1] :
-            p_int.append([pp])
-            ids.append(ibb)
-            
-    poi = p.pos
-    if p_int == []: # no interaction with canopy
-        return p, -1
-#        logging.critical('Found no intersection. Check')
-#        logging.critical(f'{p.medium}, Position {p.pos}, Direction {p.dir}')
-#        import pdb
-#        pdb.set_trace()
-    else:   
-        pmin = np.argmin(p_int)
-        pval = p_int[pmin]
-        idcol = ids[pmin]
-    #    idd = ids[idcol]
-        poi = p.pos + p_int[pmin]*p.dir
-        
-        #p.medium = scene.bbox.name[idcol]
-        return poi, idcol
+    skip = skip_id[1] if ibb == skip_id[0] else -1
+    pp, idl = geometry.do_raydisk_batch(p.pos, p.dir, normal, center, leaf['const'],
+                skip=[skip], tol=tol)
 
+    if idl == -1: # no interaction with canopy
+        return p.pos, -1
 
+    poi = p.pos + pp*p.dir
+    return poi, idl
 
 
-def run(arg, verbose = False):
-  
-    # Setting up logging
+
+
+def setup_logging(arg, verbose = False):
     root = logging.getLogger()
-    map(root.removeHandler, root.handlers[:])
-    map(root.removeFilter, root.filters[:])
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    for f in root.filters[:]:
+        root.removeFilter(f)
     lev = logging.DEBUG if verbose else logging.INFO
     if 'logfile' in arg:
         logfile = arg['logfile']
@@ -112,26 +105,35 @@ def run(arg, verbose = False):
     else:
         logging.basicConfig(level=lev, format=' %(levelname)s - %(funcName)s(): %(message)s')
 
+
+def build_scene(arg):
+    # Default scene: boundaries plus the canopy bounding boxes and their leaves
+    elements, junk = scene_conf.default_scene_elements(arg['scene_extent'])
+    scene = scene_conf.Scene()
+    scene.bbox.name     = elements['name']
+    scene.bbox.bounds   = elements['bounds'] 
+    scene.bbox.type     = elements['type']
+    scene.bbox.leaf     = elements['canopy']
+    return scene
+
+
+def run(arg, verbose = False):
+  
+    # Setting up logging
+    setup_logging(arg, verbose)
+
     # 
-    logging.debug(f'Verbose mode activated')
+    logging.debug('Verbose mode activated')
     theta_sun = arg['theta_sun']
     phi_sun   = arg['phi_sun']
     
     # (0,0,0) is placed at one of the edges by default
     scene_extent = arg['scene_extent'] 
-    elements, junk = scene_conf.default_scene_elements(scene_extent)
-    scene = scene_conf.Scene()
-    scene.bbox.name     = elements['name']
-    scene.bbox.bounds   = elements['bounds'] 
-    scene.bbox.type     = elements['type']
-    scene.bbox.leaf     = elements['canopy']
+    scene = build_scene(arg)
 
     # direct sunlight 
     direct_sun =  geometry.dir_vector(theta_sun, phi_sun)
-    observer = {'name'  : 'observer',
-                'center': [99, 50, 90],
-                'extent': [5,5, 0],
-                'normal': [0,0,-1]} # looking downwards
+    observer = default_observer
 
     Nphotons = 1
     th = theta_sun + np.pi/2.
@@ -148,7 +150,7 @@ def run(arg, verbose = False):
         p.photon[0].pos =  np.array(observer['center'])
         p.photon[0].dir = geometry.dir_vector(th, ph)
         p.photon[0].medium = 0 # within the boundaries
-        logging.info(f'photon initial direction {p.photon[0].dir} and position {p.photon[0].pos}')
+        logging.info('photon initial direction %s and position %s', p.photon[0].dir, p.photon[0].pos)
 
         pos_history.append(p.photon[0].pos)
         # bouncing photons
@@ -215,7 +217,8 @@ def run(arg, verbose = False):
                                 target = 1
 
                 
-                logging.debug(f'[{ik}], {p.photon[il].medium}, normal: {normal}, dir: {p.photon[il].dir} pos:{p.photon[il].pos}')
+                logging.debug('[%d], %s, normal: %s, dir: %s pos:%s', ik, p.photon[il].medium, normal,
+                              p.photon[il].dir, p.photon[il].pos)
                 ppos = [p.photon[x].pos for x in range(len(p.prog))]
                 pos_history.append(ppos)
             
@@ -227,6 +230,794 @@ def run(arg, verbose = False):
     return nphotons, pos_history, p
 
 
+class PhotonBatch:
+    # Structure-of-arrays version of RayBundle. Buffers are allocated once for `capacity`
+    # photons and updated in place; only the first n slots are in use.
+    # With nbands > 0 each photon carries a packet of wavelengths: weight is (capacity,
+    # nbands) and all bands share the photon's path
+    def __init__(self, capacity, nbands = 0):
+        self.capacity = capacity
+        self.n = 0
+        self.pos    = np.zeros((capacity,3))
+        self.dir    = np.zeros((capacity,3))
+        self.invdir = np.zeros((capacity,3))
+        self.sign   = np.zeros((capacity,3), dtype=np.int8)
+        self.medium = np.zeros(capacity, dtype=np.int64)
+        self.alive  = np.zeros(capacity, dtype=bool)
+        self.prog   = np.full(capacity, -1, dtype=np.int64) # parent photon, -1 for source photons
+        self.nchild = np.zeros(capacity, dtype=np.int64)
+        self.skip_leaf = np.full(capacity, -1, dtype=np.int64) # last leaf hit, never re-tested
+        self.weight = np.zeros((capacity, nbands) if nbands else capacity)
+        self.path   = np.zeros(capacity) # distance travelled
+        self.nhits  = np.zeros(capacity, dtype=np.int64) # leaf interactions
+        self.direct = np.zeros(capacity, dtype=bool) # unscattered sunlight
+        self.path_history = None # per-order copies of path, kept by trace with arg['history']
+
+    def add(self, pos, direction, prog=-1, medium=0, skip_leaf=-1, weight=1., direct=False):
+        # Appends len(pos) photons and returns their indices
+        pos = np.atleast_2d(pos)
+        k = len(pos)
+        if self.n + k > self.capacity:
+            self._grow(max(self.n + k, 2*self.capacity))
+        idx = np.arange(self.n, self.n + k)
+        self.n += k
+        self.pos[idx] = pos
+        self.set_dir(idx, direction)
+        self.medium[idx] = medium
+        self.alive[idx] = True
+        self.prog[idx] = prog
+        self.nchild[idx] = 0
+        self.skip_leaf[idx] = skip_leaf
+        self.weight[idx] = weight
+        self.path[idx] = 0
+        self.nhits[idx] = 0
+        self.direct[idx] = direct
+        return idx
+
+    def _grow(self, capacity):
+        # Reallocates all buffers; only needed when photons are split beyond the
+        # initial capacity
+        for name, val in list(vars(self).items()):
+            if isinstance(val, np.ndarray):
+                new = np.zeros((capacity,) + val.shape[1:], dtype=val.dtype)
+                new[:self.n] = val[:self.n]
+                setattr(self, name, new)
+        self.prog[self.n:] = -1
+        self.skip_leaf[self.n:] = -1
+        self.capacity = capacity
+
+    def set_dir(self, idx, direction):
+        # Updates dir, invdir and sign without allocating per-photon arrays
+        self.dir[idx] = direction
+        with np.errstate(divide='ignore'):
+            self.invdir[idx] = 1./self.dir[idx]
+        self.sign[idx] = self.invdir[idx] < 0
+
+    def live(self):
+        return np.flatnonzero(self.alive[:self.n])
+
+    @property
+    def nbands(self):
+        return self.weight.shape[1] if self.weight.ndim == 2 else 0
+
+    @classmethod
+    def concatenate(cls, batches):
+        # Joins several batches into one; parent indices are shifted accordingly
+        out = cls(sum(b.n for b in batches), batches[0].nbands)
+        for b in batches:
+            sl = slice(out.n, out.n + b.n)
+            for name in ('pos', 'dir', 'invdir', 'sign', 'medium', 'alive', 'nchild', 'skip_leaf',
+                         'weight', 'path', 'nhits', 'direct'):
+                getattr(out, name)[sl] = getattr(b, name)[:b.n]
+            out.prog[sl] = np.where(b.prog[:b.n] >= 0, b.prog[:b.n] + out.n, -1)
+            out.n += b.n
+        if all(b.path_history is not None for b in batches):
+            out.path_history = [np.concatenate(h) for h in
+                                zip(*[b.path_history for b in batches])]
+        return out
+
+
+def _wall_distance(batch, idx, scene_extent):
+    # Axis of the scene wall photons idx head for and the distance to it
+    t, axis = geometry.wall_distance(batch.pos[idx], batch.invdir[idx], scene_extent)
+    return axis, t
+
+
+def _boundary_bounce(batch, idx, scene_extent, periodic = None):
+    # Moves photons idx to the scene boundary and reflects them specularly off the wall.
+    # The scene is the axis-aligned box (0, scene_extent), so reflection flips one component.
+    # Along axes flagged in periodic, photons re-enter from the opposite side with the same
+    # direction instead. Returns the wall axis and the distance travelled
+    axis, t = _wall_distance(batch, idx, scene_extent)
+    rows = np.arange(len(idx))
+
+    batch.pos[idx] += t[:,None]*batch.dir[idx]
+    wrap = np.zeros(len(idx), dtype=bool) if periodic is None else periodic[axis]
+    if np.any(wrap):
+        rw, aw = rows[wrap], axis[wrap]
+        batch.pos[idx[rw], aw] = np.where(batch.sign[idx[rw], aw] == 0, 0., scene_extent[aw])
+        if instrument.enabled:
+            instrument.count('periodic_wraps', len(rw))
+    bounce = ~wrap
+    newdir = batch.dir[idx[bounce]].copy()
+    newdir[np.arange(len(newdir)), axis[bounce]] *= -1
+    batch.set_dir(idx[bounce], newdir)
+    batch.medium[idx] = 0
+    batch.skip_leaf[idx] = -1
+    return axis, t
+
+
+def _per_photon(x, weight):
+    # Reshapes a per-photon array x (k,) to broadcast against weights (k,) or (k,nbands)
+    return x.reshape((-1,) + (1,)*(weight.ndim - 1))
+
+
+def _leaf_interaction(batch, ih, t, idl, scene, arg, tallies, materials = None):
+    # Photons ih hit leaves idl at distance t: move them to the leaf and reflect specularly.
+    # Source photons spawn a child carrying on in the old direction (as RayBundle.add_photon)
+    old_dir = batch.dir[ih].copy()
+    batch.pos[ih] += t[:,None]*old_dir
+    batch.set_dir(ih, geometry.specular_reflection_batch(old_dir, scene.leaf_normal(idl)))
+    batch.medium[ih] = scene.leaf_bbox(idl)
+    batch.skip_leaf[ih] = idl
+    batch.nhits[ih] += 1
+
+    # leaves absorb a fraction arg['leaf_absorptance'] (default 0) of the incident flux; a
+    # photon that spawns a child hands it the share tau_leaf/(rho_leaf + tau_leaf) of the
+    # rest. Spectral runs use the material spectra instead: the reflected photon keeps rho
+    # and the child tau of the incident packet
+    win = batch.weight[ih].copy()
+    if materials is None:
+        absorbed = win*arg.get('leaf_absorptance', 0.)
+        batch.weight[ih] = win - absorbed
+        rho, tau = arg.get('rho_leaf', 0.1), arg.get('tau_leaf', 0.05)
+        wchild = (win - absorbed)*(tau/(rho + tau) if rho + tau > 0 else 0.)
+    else:
+        rho, tau = materials.optics(scene.leaf_material(idl))
+        absorbed = win*(1 - rho - tau)
+        batch.weight[ih] = win*rho
+        wchild = win*tau
+    if tallies is not None:
+        tallies.add_leaf(idl, win, absorbed, batch.direct[ih])
+    batch.direct[ih] = False
+
+    spawn = (batch.prog[ih] == -1) & (batch.nchild[ih] < arg['nplevels'])
+    if np.any(spawn):
+        parents = ih[spawn]
+        batch.add(batch.pos[parents], old_dir[spawn], prog=parents,
+                  medium=batch.medium[parents], skip_leaf=idl[spawn], weight=wchild[spawn])
+        if materials is None:
+            batch.weight[parents] -= wchild[spawn]
+        batch.nchild[parents] += 1
+        if instrument.enabled:
+            instrument.count('branches', len(parents))
+
+
+def _weighted_leaf_interaction(batch, ih, t, idl, scene, arg, tallies, rng, materials = None):
+    # Weighted-photon version of _leaf_interaction. A leaf reflects a fraction
+    # arg['rho_leaf'] and transmits arg['tau_leaf'] of the incident weight (or the material
+    # spectra in spectral runs); the rest is absorbed. Instead of branching, each photon
+    # either reflects, with probability p = mean(rho)/mean(rho+tau) over bands, or carries
+    # on through the leaf. Its weight is scaled by rho/p or tau/(1-p) in every band, so the
+    # estimate of each band stays unbiased while all bands share a single path. Black
+    # leaves (rho+tau = 0 in every band) absorb the photon
+    old_dir = batch.dir[ih].copy()
+    batch.pos[ih] += t[:,None]*old_dir
+    batch.medium[ih] = scene.leaf_bbox(idl)
+    batch.skip_leaf[ih] = idl
+    batch.nhits[ih] += 1
+
+    win = batch.weight[ih].copy()
+    if materials is None:
+        rho = np.full(len(ih), arg.get('rho_leaf', 0.1))
+        tau = np.full(len(ih), arg.get('tau_leaf', 0.05))
+    else:
+        rho, tau = materials.optics(scene.leaf_material(idl))
+    k = len(ih)
+    total = np.mean((rho + tau).reshape(k, -1), axis=1)
+    black = total <= 0
+    p = np.divide(np.mean(rho.reshape(k, -1), axis=1), total, out=np.zeros(k), where=~black)
+    reflect = rng.random(len(ih)) < p
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.where(_per_photon(reflect, win), rho/_per_photon(p, win),
+                         tau/_per_photon(1 - p, win))
+    absorbed = win*(1 - rho - tau)
+    batch.weight[ih] = win*scale
+    batch.alive[ih[black]] = False
+    if tallies is not None:
+        tallies.add_leaf(idl, win, absorbed, batch.direct[ih])
+    batch.direct[ih] = False
+
+    if np.any(reflect):
+        batch.set_dir(ih[reflect], geometry.specular_reflection_batch(old_dir[reflect],
+                            scene.leaf_normal(idl[reflect])))
+
+
+def _roulette(batch, idx, arg, rng):
+    # Russian roulette below arg['rr_threshold']: photons survive with probability
+    # w/arg['rr_survival'] and take that weight. Photons above arg['split_threshold'] are
+    # split into copies of equal weight. Both keep the expected weight unchanged. Spectral
+    # packets are judged on their mean weight over bands
+    threshold = arg.get('rr_threshold', 0.01)
+    survival = arg.get('rr_survival', 0.1)
+    w = batch.weight[idx]
+    if w.ndim == 2:
+        w = w.mean(axis=1)
+
+    sel = (w < threshold) & batch.alive[idx]
+    low = idx[sel]
+    if len(low) > 0:
+        wl = w[sel]
+        survive = rng.random(len(low))*survival < wl
+        batch.weight[low[survive]] *= _per_photon(survival/wl[survive], batch.weight)
+        batch.alive[low[~survive]] = False
+        if instrument.enabled:
+            instrument.count('roulette_killed', np.sum(~survive))
+
+    split_threshold = arg.get('split_threshold')
+    if split_threshold is None:
+        return
+    sel = (w > split_threshold) & batch.alive[idx]
+    high = idx[sel]
+    if len(high) > 0:
+        ncopy = np.ceil(w[sel]/split_threshold).astype(np.int64)
+        batch.weight[high] /= _per_photon(ncopy, batch.weight)
+        src = np.repeat(high, ncopy - 1)
+        root = np.where(batch.prog[src] >= 0, batch.prog[src], src)
+        batch.add(batch.pos[src], batch.dir[src], prog=root, medium=batch.medium[src],
+                  skip_leaf=batch.skip_leaf[src], weight=batch.weight[src],
+                  direct=batch.direct[src])
+        if instrument.enabled:
+            instrument.count('split', len(src))
+
+
+def _boundary_interaction(batch, im, scene_extent, arg, tallies, periodic = None,
+                          materials = None):
+    # Photons im hit no leaf: they travel to the scene boundary and bounce off it, or wrap
+    # around periodic sides. In spectral runs the ground reflects the
+    # arg['soil_material'] (default 'soil') spectrum. Returns the wall axis and the
+    # distance travelled
+    old_dir = batch.dir[im].copy()
+    axis, t = _boundary_bounce(batch, im, scene_extent, periodic)
+    top = (axis == 2) & (old_dir[:,2] > 0)
+    ground = (axis == 2) & (old_dir[:,2] < 0)
+    if tallies is not None:
+        tallies.add_ground(batch.pos[im[ground]], batch.weight[im[ground]])
+        tallies.add_escape(old_dir[top], batch.weight[im[top]])
+    batch.direct[im[ground]] = False
+    if materials is not None:
+        batch.weight[im[ground]] *= materials.rho[materials.index(arg.get('soil_material', 'soil'))]
+    if arg.get('open_top', False): # photons reaching the top leave the scene
+        batch.alive[im[top]] = False
+    if instrument.enabled:
+        instrument.count('boundary_fallbacks', len(im))
+    return axis, t
+
+
+def coherent_order(scene, pos, direction, medium):
+    # Permutation of the rays ordering them by direction octant, then by the grid cell
+    # they start in (or their bbox if the scene has no grid), so that the leaf search sees
+    # dense runs of rays that walk the same cells and test the same leaves
+    octant = (direction < 0) @ np.array([4, 2, 1])
+    grid = getattr(scene, 'grid', None)
+    cell = grid.cell_of(pos) if grid is not None else medium.astype(np.int64)
+    return np.argsort(octant*(cell.max() + 1) + cell)
+
+
+def _search(batch, idx, scene, arg, scene_extent, rng):
+    # Distance to and index of the leaf each photon idx interacts with next (inf, -1 if
+    # none before the wall)
+    pos, direction = batch.pos[idx], batch.dir[idx]
+    if arg.get('coherent', False):
+        # search in coherent order, results back in photon order
+        with instrument.phase('sort'):
+            order = coherent_order(scene, pos, direction, batch.medium[idx])
+            rays = idx[order]
+        t, idl = np.empty(len(idx)), np.empty(len(idx), dtype=np.int64)
+        t[order], idl[order] = scene.nearest_leaf(pos[order], direction[order],
+                                                  batch.invdir[rays], batch.skip_leaf[rays])
+    else:
+        t, idl = scene.nearest_leaf(pos, direction, batch.invdir[idx], batch.skip_leaf[idx])
+    if getattr(scene, 'turbid', None) is not None:
+        # turbid bboxes: a collision sampled before the leaf hit or the wall replaces it
+        limit = np.where(idl >= 0, t, _wall_distance(batch, idx, scene_extent)[1])
+        tm, im = scene.medium_collision(pos, direction, limit, rng)
+        closer = im >= 0
+        t[closer], idl[closer] = tm[closer], im[closer]
+    return t, idl
+
+
+def scatter_step(batch, scene, arg, tallies = None, rng = None, materials = None):
+    # Advances every live photon by one scattering order. scene is a CompiledScene or an
+    # InstancedScene (anything with nearest_leaf, leaf_normal, leaf_bbox and
+    # leaf_material). Tallies, if given, are updated in place.
+    # arg['periodic'] ('x', 'y' or 'xy') makes those scene sides wrap around, so that one
+    # tile stands for an infinite block of rows. Leaves are not replicated across the seam:
+    # canopies should lie inside the tile. Side walls, wrapped or mirrored, are not
+    # interactions: photons crossing them carry on within the same order, through up to
+    # arg['max_walls'] (default 64) walls, so only leaf, ground and sky events use up
+    # the arg['nscat'] orders.
+    # With arg['weighted'] leaves reflect/transmit with weights and low-weight photons are
+    # terminated by Russian roulette (rng is then required).
+    # materials (pdf.Materials) makes the step spectral: batch weights are per band.
+    # arg['coherent'] searches leaves with the rays sorted by coherent_order; results are
+    # the same, and it only pays off when the leaf arrays no longer fit in cache.
+    # Scenes with turbid bboxes (CompiledScene.set_lod) also sample collisions in those
+    # (rng is then required)
+    scene_extent = np.asarray(arg['scene_extent'], dtype=float)
+    periodic = sunlit.periodic_axes(arg)
+    idx = batch.live()
+    if len(idx) == 0:
+        return
+    batch.pos[idx] = np.clip(batch.pos[idx], 0, scene_extent)
+    every = idx
+
+    for iwall in range(arg.get('max_walls', 64) + 1):
+        p0 = batch.pos[idx].copy()
+        d0 = batch.dir[idx].copy()
+        w0 = batch.weight[idx].copy()
+        t, idl = _search(batch, idx, scene, arg, scene_extent, rng)
+        hit = idl >= 0
+
+        if np.any(hit):
+            with instrument.phase('reflection'):
+                if arg.get('weighted', False):
+                    _weighted_leaf_interaction(batch, idx[hit], t[hit], idl[hit], scene, arg,
+                                               tallies, rng, materials)
+                else:
+                    _leaf_interaction(batch, idx[hit], t[hit], idl[hit], scene, arg, tallies,
+                                      materials)
+        side = np.zeros(len(idx), dtype=bool)
+        if not np.all(hit):
+            with instrument.phase('boundary'):
+                axis, t[~hit] = _boundary_interaction(batch, idx[~hit], scene_extent, arg,
+                                                      tallies, periodic, materials)
+            side[~hit] = axis != 2
+
+        # the segment travelled; with periodic sides the new position may have wrapped
+        # around, so it is rebuilt from the old direction
+        batch.path[idx] += t
+        if tallies is not None:
+            tallies.add_crossing(p0, p0 + t[:,None]*d0, w0)
+        idx = idx[side]
+        if len(idx) == 0:
+            break
+
+    if arg.get('weighted', False):
+        _roulette(batch, every, arg, rng)
+
+
+def compiled_scene(arg, scene = None):
+    # Scene for the batch tracer: loaded (or generated and cached) from arg if scene is
+    # None, or an InstancedScene if arg['instanced'] is set; a Scene is compiled and
+    # anything else is returned as is.
+    # arg['lod_bboxes'] and arg['lod_distance'] turn canopy bboxes of a CompiledScene into
+    # turbid media with arg['lod_voxels'] (default (1,1,1)) voxels each (see
+    # scene_conf.lod_bboxes)
+    grid = arg.get('accel', 'grid') == 'grid'
+    if scene is None and arg.get('instanced', False):
+        return scene_conf.instanced_scene(arg, grid=grid)
+    if scene is None:
+        scene = scene_conf.load_scene(arg, grid=grid)
+    elif isinstance(scene, scene_conf.Scene):
+        scene = scene_conf.compile_scene(scene)
+        if grid:
+            scene.build_grid()
+    if isinstance(scene, scene_conf.CompiledScene) and \
+            ('lod_bboxes' in arg or arg.get('lod_distance') is not None):
+        boxes = scene_conf.lod_bboxes(scene, arg, arg.get('observer', default_observer))
+        scene.set_lod(boxes, arg.get('lod_voxels', (1,1,1)))
+    return scene
+
+
+def trace(arg, scene, rng, tallies = None):
+    # Traces arg['nphotons'] source photons through a CompiledScene. Source photons are
+    # spread uniformly over the observer footprint using rng. Results are accumulated in
+    # tallies (a new tally.Tallies if None); per-order positions of every photon are only
+    # kept if arg['history'] is set, together with the distances travelled so far in
+    # batch.path_history. Giving arg['wavelengths'] or arg['materials'] traces
+    # spectral packets (see pdf.materials_for): tallies then have a band axis.
+    # With arg['sky'] source photons are split between direct sun and diffuse sky light
+    # using the clear-sky tables of atmosphere.sky_tables.
+    # arg['trajectory'] streams sampled per-order photon records to disk instead (see
+    # trajectory.recorder_for)
+    theta_sun = arg['theta_sun']
+    phi_sun   = arg['phi_sun']
+    nplevels = arg['nplevels']
+    nphotons = arg.get('nphotons', 1)
+    observer = arg.get('observer', default_observer)
+    materials = pdf.materials_for(arg)
+    nbands = 0 if materials is None else materials.nbands
+    if tallies is None:
+        tallies = tally.Tallies.for_scene(arg, scene.nleaves, observer, nbands)
+
+    # weighted photons never branch, so no room is needed for children
+    batch = PhotonBatch(nphotons if arg.get('weighted', False) else nphotons*(1 + nplevels),
+                        nbands)
+    pos0 = np.asarray(observer['center'], dtype=float) + \
+        (rng.random((nphotons,3)) - 0.5)*np.asarray(observer['extent'], dtype=float)
+    dir0 = geometry.dir_vector(theta_sun + np.pi/2., phi_sun)
+    if arg.get('sky', False):
+        wavelengths = None if materials is None else materials.wavelengths
+        dirs, weight, direct = atmosphere.sky_source(arg, atmosphere.sky_tables(arg), nphotons,
+                                                     rng, wavelengths)
+        batch.add(pos0, dirs, weight=weight, direct=direct)
+    else:
+        batch.add(pos0, dir0, direct=True)
+    logging.info('%d photons, initial direction %s', nphotons, dir0)
+
+    pos_history = [batch.pos[:batch.n].copy()] if arg.get('history', False) else None
+    if pos_history is not None:
+        batch.path_history = [batch.path[:batch.n].copy()]
+    recorder = trajectory.recorder_for(arg)
+    if recorder is not None:
+        recorder.record(batch, np.arange(batch.n), 0)
+    for ik in range(arg['nscat']):
+        live, n0 = batch.live(), batch.n
+        scatter_step(batch, scene, arg, tallies, rng, materials)
+        if pos_history is not None:
+            pos_history.append(batch.pos[:batch.n].copy())
+            batch.path_history.append(batch.path[:batch.n].copy())
+        if recorder is not None:
+            # photons that moved, and branches spawned during this order
+            recorder.record(batch, np.concatenate([live, np.arange(n0, batch.n)]), ik + 1)
+        logging.debug('[%d] %d photons', ik, batch.n)
+    if recorder is not None:
+        recorder.close()
+
+    # per source photon totals over all of its branches
+    root = np.where(batch.prog[:batch.n] >= 0, batch.prog[:batch.n], np.arange(batch.n))
+    tallies.add_sources(np.bincount(root, weights=batch.nhits[:batch.n], minlength=nphotons),
+                        np.bincount(root, weights=batch.path[:batch.n], minlength=nphotons))
+
+    return batch.n, pos_history, batch, tallies
+
+
+def run_batch(arg, verbose = False, scene = None, rng = None):
+    # Vectorised counterpart of run(): arg['nphotons'] source photons are emitted from the
+    # observer footprint and all live photons advance one scattering order per step.
+    # Returns the number of photons (including branches), the positions of all photons
+    # after every scattering order (None unless arg['history']), the final PhotonBatch
+    # and the tally.Tallies.
+    setup_logging(arg, verbose)
+    _setup_instrument(arg)
+    if rng is None:
+        rng = np.random.default_rng(arg.get('seed'))
+    with instrument.phase('scene_build'):
+        scene = compiled_scene(arg, scene)
+    out = trace(arg, scene, rng)
+    if instrument.enabled:
+        logging.info('instrumentation report\n%s', instrument.format_report())
+    return out
+
+
+def _setup_instrument(arg):
+    # arg['instrument'] switches counters and phase timers on (and resets them); the
+    # report is then available from instrument.report() after the run
+    instrument.enable(arg.get('instrument', False))
+    if instrument.enabled:
+        instrument.reset()
+
+
+# Scene shared by all photons traced in a worker process, set once by _init_worker
+_worker_scene = None
+
+def _init_worker(scene):
+    global _worker_scene
+    _worker_scene = scene
+
+def _trace_worker(job):
+    # returns the trace() output and the worker's instrumentation report
+    arg, seed = job
+    _setup_instrument(arg)
+    out = trace(arg, _worker_scene, np.random.default_rng(seed))
+    return out, instrument.report()
+
+
+def merge_results(results):
+    # Combines the outputs of several trace() calls, in the order given
+    nphotons = sum(r[0] for r in results)
+    pos_history = None
+    if results[0][1] is not None:
+        pos_history = [np.concatenate(h) for h in zip(*[r[1] for r in results])]
+    batch = PhotonBatch.concatenate([r[2] for r in results])
+    tallies = results[0][3]
+    for r in results[1:]:
+        tallies.merge(r[3])
+    return nphotons, pos_history, batch, tallies
+
+
+# arg keys that define the scene; they cannot change between the configurations of a
+# Simulation since the scene is only built once
+SCENE_KEYS = ('scene_extent', 'ntrees', 'nrows', 'leaves_shoot_half', 'seed', 'instanced',
+              'nprototypes', 'instance_rotation', 'accel', 'scene_cache', 'lod_bboxes',
+              'lod_distance', 'lod_voxels')
+
+def _checkpoint_run(state):
+    # What a converge checkpoint must share with the run resuming it; configs may hold
+    # arrays, so they are compared by their repr
+    return (state['seed'], state['round_photons'], state.get('nworkers'),
+            repr(sorted(state.get('config', {}).items())))
+
+
+def _render_worker(job):
+    # one camera tile; returns the tile's pixel range, its image and the report
+    arg, tile, shape, spp, seed = job
+    _setup_instrument(arg)
+    with instrument.phase('render'):
+        img = camera.render_tile(arg, _worker_scene, arg.get('observer', default_observer),
+                                 tile, shape, spp, np.random.default_rng(seed),
+                                 pdf.materials_for(arg))
+    return (tile, img), instrument.report()
+
+def _sweep_worker(job):
+    # as _trace_worker, but only the tallies are sent back
+    out, report = _trace_worker(job)
+    return out[3], report
+
+
+class Simulation:
+    # Persistent simulation: the scene and its acceleration grid are built once and the
+    # worker pool stays alive, so that many sun positions or observers can be evaluated
+    # without paying the setup again.
+    #
+    #   with Simulation(arg, nworkers=8) as sim:
+    #       stacked = sim.sweep([{'theta_sun': t, 'phi_sun': p} for t, p in suns])
+    #
+    # Each configuration is a dict of arg overrides (sun angles, observer, sky, ...).
+    # The photons of a configuration are split over the workers with Generators spawned
+    # from arg['seed'], so results only depend on the seed and the number of workers
+    def __init__(self, arg, nworkers = None, verbose = False, scene = None):
+        self.arg = arg
+        setup_logging(arg, verbose)
+        _setup_instrument(arg)
+        self.nworkers = arg.get('nworkers', os.cpu_count()) if nworkers is None else nworkers
+        with instrument.phase('scene_build'):
+            self.scene = compiled_scene(arg, scene)
+        self.build_report = instrument.report()
+        self.pool = None
+        if self.nworkers > 1:
+            self.pool = multiprocessing.Pool(self.nworkers, initializer=_init_worker,
+                                             initargs=(self.scene,))
+        else:
+            _init_worker(self.scene)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    @staticmethod
+    def _check(config):
+        bad = [k for k in config if k in SCENE_KEYS]
+        if bad:
+            raise ValueError(f'cannot change scene parameters {bad} between configurations')
+
+    def _jobs(self, config, seed, tag = ''):
+        # One job per worker. Source photon ids stay global through arg['photon_offset'],
+        # and each job records its trajectories to <trajectory><tag>.<worker>
+        self._check(config)
+        arg = dict(self.arg, **config)
+        seeds = seed.spawn(self.nworkers)
+        counts = [len(c) for c in np.array_split(np.arange(arg.get('nphotons', 1)),
+                                                 self.nworkers)]
+        offsets = np.cumsum([0] + counts[:-1])
+        jobs = []
+        for w, (c, s) in enumerate(zip(counts, seeds)):
+            job = dict(arg, nphotons=c, photon_offset=int(offsets[w]))
+            if arg.get('trajectory') and (self.nworkers > 1 or tag):
+                job['trajectory'] = f"{arg['trajectory']}{tag}.{w}"
+            jobs.append((job, s))
+        return jobs
+
+    def _map(self, worker, jobs):
+        if self.pool is None:
+            results = [worker(job) for job in jobs]
+        else:
+            results = self.pool.map(worker, jobs, chunksize=1)
+        if instrument.enabled:
+            instrument.reset()
+            instrument.merge(self.build_report)
+            for out, rep in results:
+                instrument.merge(rep)
+            logging.info('instrumentation report\n%s', instrument.format_report())
+        return [out for out, rep in results]
+
+    def run(self, config = None):
+        # One configuration (arg overrides, or arg itself if None). Returns the same as
+        # run_batch, with per-worker results merged in worker order
+        jobs = self._jobs(config or {}, np.random.SeedSequence(self.arg.get('seed')))
+        logging.info('%d photons over %d workers', sum(j[0]['nphotons'] for j in jobs),
+                     self.nworkers)
+        return merge_results(self._map(_trace_worker, jobs))
+
+    def sweep(self, configs):
+        # Evaluates a list of configurations in a single pool map and returns their
+        # tallies stacked along a first axis (tally.stack). Configuration i draws from the
+        # i-th child of arg['seed']
+        seeds = np.random.SeedSequence(self.arg.get('seed')).spawn(len(configs))
+        jobs = [job for i, (config, seed) in enumerate(zip(configs, seeds))
+                for job in self._jobs(config, seed, f'.{i}')]
+        logging.info('%d configurations over %d workers', len(configs), self.nworkers)
+        tallies = self._map(_sweep_worker, jobs)
+
+        merged = []
+        for i in range(len(configs)):
+            parts = tallies[i*self.nworkers:(i+1)*self.nworkers]
+            for t in parts[1:]:
+                parts[0].merge(t)
+            merged.append(parts[0])
+        return tally.stack(merged)
+
+    def converge(self, target = 0.01, time_budget = None, round_photons = None,
+                 max_rounds = 1000, min_rounds = 4, checkpoint = None, config = None):
+        # Progressive run: traces rounds of round_photons (default arg['nphotons']) source
+        # photons until the relative standard error of every tally total
+        # (Tallies.totals) is below target, the time budget (seconds, including time
+        # spent before a resume) is used up, or max_rounds is reached. The error is
+        # estimated from the spread of the per-round totals (batch means), and only trusted
+        # after min_rounds rounds.
+        # With a checkpoint path, the merged tallies and round statistics are saved after
+        # every round and a later call with the same path resumes from there. Round r
+        # draws from the r-th child of arg['seed'], so a resumed run gives the same
+        # result as an uninterrupted one; resuming with another seed, round size, config
+        # or number of workers raises ValueError.
+        # Returns the merged Tallies and a dict with rounds, nsource, the relative error of
+        # each total, elapsed time and the reason for stopping
+        config = dict(config or {})
+        arg = dict(self.arg, **config)
+        round_photons = round_photons or arg.get('nphotons', 1)
+        state = {'seed': arg.get('seed'), 'round_photons': round_photons, 'config': config,
+                 'nworkers': self.nworkers, 'round': 0, 'elapsed': 0., 'tallies': None,
+                 'stats': {}}
+        if checkpoint is not None and os.path.exists(checkpoint):
+            with open(checkpoint, 'rb') as f:
+                saved = pickle.load(f)
+            if _checkpoint_run(saved) != _checkpoint_run(state):
+                raise ValueError(f'{checkpoint}: checkpoint of a run with another seed, '
+                                 'round size, config or number of workers')
+            state = saved
+            logging.info('resuming from %s after %d rounds', checkpoint, state['round'])
+
+        t0 = time.perf_counter() - state['elapsed']
+        rel = {}
+        reason = 'max_rounds'
+        while state['round'] < max_rounds:
+            r = state['round']
+            seed = np.random.SeedSequence(arg.get('seed'), spawn_key=(r,))
+            parts = self._map(_sweep_worker, self._jobs(dict(config or {},
+                                  nphotons=round_photons), seed, f'.r{r}'))
+            for t in parts[1:]:
+                parts[0].merge(t)
+
+            for name, val in parts[0].totals().items():
+                state['stats'].setdefault(name, tally.RunningStat(np.shape(val))).update([val])
+            if state['tallies'] is None:
+                state['tallies'] = parts[0]
+            else:
+                state['tallies'].merge(parts[0])
+            state['round'] = r + 1
+            state['elapsed'] = time.perf_counter() - t0
+
+            if checkpoint is not None:
+                tmp = checkpoint + '.tmp'
+                with open(tmp, 'wb') as f:
+                    pickle.dump(state, f)
+                os.replace(tmp, checkpoint)
+
+            rel = {}
+            for name, st in state['stats'].items():
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    e = st.sem/np.abs(st.mean)
+                # tallies that stay zero have nothing to converge
+                e = np.where(st.mean == 0, 0., e)
+                rel[name] = float(np.max(e)) if st.n >= max(min_rounds, 2) else np.inf
+            logging.info('round %d: %d photons, max relative error %.3g', r + 1,
+                         state['tallies'].nsource, max(rel.values()))
+            if max(rel.values()) <= target:
+                reason = 'target'
+                break
+            if time_budget is not None and state['elapsed'] >= time_budget:
+                reason = 'time_budget'
+                break
+
+        info = {'rounds': state['round'], 'nsource': state['tallies'].nsource,
+                'rel_error': rel, 'elapsed': state['elapsed'], 'reason': reason}
+        return state['tallies'], info
+
+    def render(self, shape = (256,256), tile = 64, spp = 1, config = None):
+        # Backward-traced camera image of the observer, (shape) or (shape + (nbands,)) in
+        # spectral runs. Tiles of tile x tile pixels are spread over the workers and
+        # stitched; tile k draws its pixel jitter from the k-th child of arg['seed']
+        self._check(config or {})
+        if getattr(self.scene, 'turbid', None) is not None:
+            # camera rays only test leaf disks, so turbid bboxes would look transparent
+            raise ValueError('cannot render a scene with turbid bboxes (lod_bboxes)')
+        arg = dict(self.arg, **(config or {}))
+        parts = camera.tiles(shape, tile)
+        seeds = np.random.SeedSequence(arg.get('seed')).spawn(len(parts))
+        logging.info('%dx%d image, %d tiles over %d workers', shape[0], shape[1], len(parts),
+                     self.nworkers)
+        results = self._map(_render_worker,
+                            [(arg, t, shape, spp, s) for t, s in zip(parts, seeds)])
+        image = np.zeros(tuple(shape) + results[0][1].shape[2:])
+        for (r0, r1, c0, c1), img in results:
+            image[r0:r1, c0:c1] = img
+        return image
+
+
+def run_direct(arg, verbose = False, scene = None, rng = None):
+    # First-order direct sunlight only (see sunlit.py): no photons are traced, one shadow
+    # ray is cast per sample point of every leaf (arg['sun_samples'], default 4) and of
+    # every ground cell (arg['ground_bins'], arg['ground_samples'], default 1). Returns a
+    # dict with per leaf leaf_sunlit (fraction of the leaf seeing the sun), leaf_cos and
+    # leaf_direct (direct irradiance relative to the horizontal irradiance above the
+    # canopy, as irradiance.LeafIrradiance.direct), ground_sunlit per ground cell, and
+    # the sunlit shares leaf_fraction (of the leaf area) and ground_fraction
+    setup_logging(arg, verbose)
+    _setup_instrument(arg)
+    if rng is None:
+        rng = np.random.default_rng(arg.get('seed'))
+    with instrument.phase('scene_build'):
+        scene = compiled_scene(arg, scene)
+    if getattr(scene, 'turbid', None) is not None:
+        # shadow rays only test leaf disks, so turbid bboxes would cast no shadow
+        raise ValueError('cannot cast shadow rays through a scene with turbid bboxes '
+                         '(lod_bboxes)')
+    sun = sunlit.sun_direction(arg['theta_sun'], arg['phi_sun'])
+    periodic = sunlit.periodic_axes(arg)
+    with instrument.phase('shadow_rays'):
+        frac, cos = sunlit.leaf_sunlit(scene, sun, arg['scene_extent'],
+                                       arg.get('sun_samples', 4), rng, periodic)
+        ground = sunlit.ground_sunlit(scene, sun, arg['scene_extent'],
+                                      arg.get('ground_bins', (50,50)),
+                                      arg.get('ground_samples', 1), rng, periodic)
+    area = np.pi*scene.leaf_radius(np.arange(scene.nleaves))**2
+    if instrument.enabled:
+        logging.info('instrumentation report\n%s', instrument.format_report())
+    return {'leaf_sunlit': frac, 'leaf_cos': cos, 'leaf_direct': frac*cos/max(sun[2], 1e-6),
+            'ground_sunlit': ground,
+            'leaf_fraction': np.sum(frac*area)/max(area.sum(), 1e-300),
+            'ground_fraction': ground.mean()}
+
+
+def render_image(arg, shape = (256,256), tile = 64, spp = 1, nworkers = None,
+                 verbose = False, scene = None):
+    # Camera image of the observer (see camera.py), rendered tile by tile over a pool of
+    # nworkers processes
+    with Simulation(arg, nworkers, verbose, scene) as sim:
+        return sim.render(shape, tile, spp)
+
+
+def run_progressive(arg, nworkers = None, verbose = False, scene = None):
+    # Simulation.converge with arg['target_rel_error'] (default 0.01), arg['time_budget'],
+    # arg['round_photons'], arg['max_rounds'] and arg['checkpoint']
+    with Simulation(arg, nworkers, verbose, scene) as sim:
+        return sim.converge(target=arg.get('target_rel_error', 0.01),
+                            time_budget=arg.get('time_budget'),
+                            round_photons=arg.get('round_photons'),
+                            max_rounds=arg.get('max_rounds', 1000),
+                            checkpoint=arg.get('checkpoint'))
+
+
+def run_parallel(arg, nworkers = None, verbose = False, scene = None):
+    # Splits arg['nphotons'] over a pool of nworkers processes. The compiled scene is sent
+    # to each worker once (as a path to memory-map if it comes from the scene cache) and
+    # every worker draws from its own Generator spawned from arg['seed'], so results only
+    # depend on the seed and the number of workers.
+    # Returns the same as run_batch, with per-worker results merged in worker order
+    with Simulation(arg, nworkers, verbose, scene) as sim:
+        return sim.run()
+
+
 if __name__ == '__main__':
     run()
 
@@ -1,8 +1,14 @@
 # Scene elements and their properties are defined here
 # comment
 
+import os
+import json
+import hashlib
 import numpy as np
 import geometry
+import accel
+import instrument
+import turbid
 
 class scene_element:
     
@@ -19,10 +25,557 @@ class Scene:
     def __init__(self): # p contains all boundary elements
         self.dimensions = np.zeros(3) # (0,x1), (0,x2), (0,x3)
         self.bbox = scene_element() # boundary boxes need to be specified explicitly
-        
 
 
-def default_scene_elements(scene_extent):
+
+def pack_leaves(scene):
+    # Packs the per-bbox leaf lists of a scene into contiguous arrays. Leaves of bbox ibb
+    # occupy the global index range offset[ibb]:offset[ibb+1]
+    centers = []
+    normals = []
+    radii = []
+    labels = {'material': [], 'tree': [], 'cane': []}
+    offset = np.zeros(len(scene.bbox.name)+1, dtype=np.int64)
+
+    for ibb, leaf in enumerate(scene.bbox.leaf):
+        nl = len(leaf['center']) if len(leaf) > 0 else 0
+        if nl > 0:
+            centers.append(np.asarray(leaf['center'], dtype=float))
+            normals.append(np.asarray(leaf['normal'], dtype=float))
+            radii.append(np.asarray(leaf['radius'], dtype=float))
+            # material id per leaf (pdf.Materials row), 0 if the generator sets none,
+            # and the tree and cane each leaf grows on, -1 if unknown
+            for name, default in (('material', 0), ('tree', -1), ('cane', -1)):
+                labels[name].append(np.broadcast_to(np.asarray(leaf.get(name, default),
+                                                               dtype=np.int64), (nl,)))
+        offset[ibb+1] = offset[ibb] + nl
+
+    leaves = {}
+    leaves['center'] = np.concatenate(centers) if centers else np.zeros((0,3))
+    leaves['normal'] = np.concatenate(normals) if normals else np.zeros((0,3))
+    leaves['radius'] = np.concatenate(radii) if radii else np.zeros(0)
+    for name, val in labels.items():
+        leaves[name] = np.concatenate(val) if val else np.zeros(0, dtype=np.int64)
+    leaves['offset'] = offset
+    leaves['bbox'] = np.repeat(np.arange(len(offset)-1), np.diff(offset))
+    leaves.update(geometry.disk_constants(leaves['normal'], leaves['center'], leaves['radius']))
+    return leaves
+
+
+# Bumped whenever the layout of a compiled scene or the scene generator changes, so that
+# stale cache entries are never reused
+SCENE_VERSION = 5
+
+class CompiledScene:
+    # Contiguous-array representation of a scene used by the batch tracer:
+    #   bounds (nbb,2,3), name and type per bbox
+    #   leaf: center, normal (nl,3), radius, bbox (nl,), offset (nbb+1,) such that the
+    #   leaves of bbox ibb are offset[ibb]:offset[ibb+1], plus the disk constants d, r2, cc
+    #   and the material id, tree and cane (-1 if unknown) of every leaf
+    # A scene loaded from the cache is memory-mapped read-only, and is pickled as its path
+    # so worker processes map the same files instead of receiving copies
+    arrays = ('bounds', 'center', 'normal', 'radius', 'material', 'tree', 'cane', 'bbox',
+              'offset', 'd', 'r2', 'cc')
+
+    # per-leaf arrays, grown together by insert_leaves
+    per_leaf = ('center', 'normal', 'radius', 'material', 'tree', 'cane', 'bbox', 'd', 'r2',
+                'cc')
+
+    def __init__(self, name, type, bounds, leaf, key=None, path=None):
+        self.name = list(name)
+        self.type = list(type)
+        self.bounds = bounds
+        self.leaf = leaf
+        self.key = key
+        self.path = path
+        self.grid = None
+        # leaves inserted after compilation live past offset[-1], with their own bounds
+        self.tail_bounds = None
+        self._buf = None
+        # turbid.TurbidMedium standing for the leaves of some bboxes (set_lod)
+        self.turbid = None
+
+    @property
+    def nleaves(self):
+        return len(self.leaf['radius'])
+
+    def build_grid(self, **kw):
+        active = None if self.turbid is None else self.explicit_bboxes()[self.leaf['bbox']]
+        self.grid = accel.UniformGrid(self.leaf['center'], self.leaf['normal'],
+                        self.leaf['radius'], const={k: self.leaf[k] for k in ('d', 'r2', 'cc')},
+                        active=active, **kw)
+        return self.grid
+
+    def leaf_bounds(self):
+        # Axis-aligned box (2,3) holding every leaf disk, inserted ones included (the
+        # last bbox if there are no leaves)
+        live = self.leaf['r2'] >= 0
+        if not np.any(live):
+            return np.asarray(self.bounds[-1], dtype=float)
+        lo, hi = geometry.disk_aabb(self.leaf['normal'][live], self.leaf['center'][live],
+                                    self.leaf['radius'][live])
+        return np.array([lo.min(axis=0), hi.max(axis=0)])
+
+    def explicit_bboxes(self):
+        # Mask of the bboxes whose leaves are traced as disks
+        mask = np.ones(len(self.bounds), dtype=bool)
+        if self.turbid is not None:
+            mask[self.turbid.boxes] = False
+        return mask
+
+    def set_lod(self, boxes, voxels = (1,1,1)):
+        # Traces the leaves of bboxes `boxes` as a turbid medium with `voxels` (nx, ny, nz)
+        # voxels per bbox instead of as disks (see turbid.py); an empty list switches back
+        # to disks everywhere. The leaf search then skips those bboxes, and the tracer
+        # samples collisions in them with medium_collision
+        boxes = np.unique(np.asarray(boxes, dtype=np.int64))
+        lod = (tuple(int(b) for b in boxes), tuple(int(x) for x in voxels))
+        if self.lod() == (lod if len(boxes) > 0 else None):
+            return
+        self.turbid = turbid.TurbidMedium(self, boxes, voxels) if len(boxes) > 0 else None
+        if self.grid is not None:
+            self.build_grid(cell_size=self.grid.cell_size, max_cells=self.grid.max_cells)
+
+    def lod(self):
+        # (boxes, voxels) of the turbid medium, None if every leaf is a disk
+        if self.turbid is None:
+            return None
+        return tuple(int(b) for b in self.turbid.boxes), self.turbid.voxels
+
+    def medium_collision(self, pos, direction, t_max, rng):
+        # First collision with the turbid bboxes before t_max: distances (inf if none)
+        # and the leaves interacted with (-1 if none)
+        if self.turbid is None:
+            return np.full(len(pos), np.inf), np.full(len(pos), -1, dtype=np.int64)
+        with instrument.phase('medium'):
+            return self.turbid.collide(pos, direction, t_max, rng)
+
+    def nearest_leaf(self, pos, direction, invdir, skip=None, one_sided=True, any_hit=False):
+        # Closest leaf along each ray, through the grid if built, otherwise by bbox.
+        # Returns distances (inf if no hit) and leaf indices (-1 if no hit). Leaves are
+        # only hit from the side their normal points to unless one_sided is False. With
+        # any_hit, some leaf hit is returned rather than the closest (for shadow rays)
+        # Leaves of turbid bboxes (set_lod) are never hit
+        if self.grid is not None:
+            with instrument.phase('leaf_search'):
+                return self.grid.nearest(pos, direction, skip=skip, one_sided=one_sided,
+                                         any_hit=any_hit)
+        if skip is None:
+            skip = np.full(len(pos), -1)
+        leaf, bounds = self.leaf, self.bounds
+        active = None if self.turbid is None else self.explicit_bboxes()
+        if self.nleaves > leaf['offset'][-1]:
+            # inserted leaves are searched as one more box
+            leaf = dict(leaf, offset=np.append(leaf['offset'], self.nleaves))
+            bounds = np.concatenate([bounds, [self.tail_bounds]])
+        return accel.nearest_by_bbox(pos, direction, invdir, leaf, bounds, skip,
+                                     one_sided=one_sided, any_hit=any_hit, active=active)
+
+    def leaf_normal(self, idl):
+        return self.leaf['normal'][idl]
+
+    def leaf_bbox(self, idl):
+        return self.leaf['bbox'][idl]
+
+    def leaf_material(self, idl):
+        return self.leaf['material'][idl]
+
+    def leaf_tree(self, idl):
+        return self.leaf['tree'][idl]
+
+    def leaf_cane(self, idl):
+        return self.leaf['cane'][idl]
+
+    def leaf_center(self, idl):
+        return self.leaf['center'][idl]
+
+    def leaf_radius(self, idl):
+        return self.leaf['radius'][idl]
+
+    def content_hash(self):
+        # Hash of the leaf geometry and materials, so that results computed for this scene
+        # can be cached; unlike key it follows incremental edits
+        h = hashlib.sha1(str(SCENE_VERSION).encode())
+        for name in self.per_leaf:
+            h.update(np.ascontiguousarray(self.leaf[name]).tobytes())
+        if self.turbid is not None:
+            h.update(str(self.lod()).encode())
+        return h.hexdigest()[:16]
+
+    # Incremental edits, e.g. for growth or pruning between runs. Leaf indices stay stable
+    # (removed leaves become tombstones that can never be hit, inserted leaves are
+    # appended) and only the changed leaves are refitted: their disk constants, the
+    # bounds of their bbox (which may only grow) and the grid cells they overlap. A scene
+    # mapped from the cache is first copied to memory and detached from it. Scenes with
+    # turbid bboxes must be switched back to disks (set_lod([])) before editing.
+
+    def _reserve(self, k):
+        # Makes the per-leaf arrays writable with room for k more leaves
+        if self.turbid is not None:
+            raise ValueError('leaves cannot be edited while some bboxes are turbid')
+        n = self.nleaves
+        if self._buf is None or n + k > len(self._buf['radius']):
+            cap = max(n + k, 2*n, 16)
+            buf = {}
+            for name in self.per_leaf:
+                arr = self.leaf[name]
+                buf[name] = np.zeros((cap,) + arr.shape[1:], dtype=arr.dtype)
+                buf[name][:n] = arr
+            self._buf = buf
+            self.bounds = np.array(self.bounds, dtype=float)
+            self.leaf['offset'] = np.array(self.leaf['offset'])
+            self.path = None
+        for name in self.per_leaf:
+            self.leaf[name] = self._buf[name][:n + k]
+        # the grid reads the leaf arrays directly, so it must see the new ones
+        if self.grid is not None:
+            self.grid.rebind(self.leaf['center'], self.leaf['normal'], self.leaf['radius'],
+                             {k: self.leaf[k] for k in ('d', 'r2', 'cc')})
+
+    def _refit(self, idl):
+        idl = np.asarray(idl, dtype=np.int64)
+        const = geometry.disk_constants(self.leaf['normal'][idl], self.leaf['center'][idl],
+                                        self.leaf['radius'][idl])
+        for name, val in const.items():
+            self.leaf[name][idl] = val
+        lo, hi = geometry.disk_aabb(self.leaf['normal'][idl], self.leaf['center'][idl],
+                                    self.leaf['radius'][idl])
+        tail = idl >= self.leaf['offset'][-1]
+        if np.any(tail):
+            box = np.array([lo[tail].min(axis=0), hi[tail].max(axis=0)])
+            if self.tail_bounds is not None:
+                box = np.array([np.minimum(box[0], self.tail_bounds[0]),
+                                np.maximum(box[1], self.tail_bounds[1])])
+            self.tail_bounds = box
+        ibb = self.leaf['bbox'][idl]
+        np.minimum.at(self.bounds[:,0], ibb, lo)
+        np.maximum.at(self.bounds[:,1], ibb, hi)
+        if self.grid is not None:
+            self.grid.update(idl)
+
+    def insert_leaves(self, center, normal, radius, bbox = 1, material = 0, tree = -1,
+                      cane = -1):
+        # Appends disks to bbox (index of an existing bbox) and returns their indices
+        center = np.atleast_2d(np.asarray(center, dtype=float))
+        k = len(center)
+        n = self.nleaves
+        self._reserve(k)
+        idl = np.arange(n, n + k)
+        self.leaf['center'][idl] = center
+        self.leaf['normal'][idl] = normal
+        self.leaf['radius'][idl] = radius
+        self.leaf['material'][idl] = material
+        self.leaf['tree'][idl] = tree
+        self.leaf['cane'][idl] = cane
+        self.leaf['bbox'][idl] = bbox
+        self._refit(idl)
+        return idl
+
+    def remove_leaves(self, idl):
+        # Leaves idl can no longer be hit; their indices are not reused
+        self._reserve(0)
+        self.leaf['radius'][idl] = 0
+        self.leaf['r2'][idl] = -1
+
+    def modify_leaves(self, idl, center = None, normal = None, radius = None,
+                      material = None):
+        # Moves, reorients, resizes or changes the material of leaves idl
+        self._reserve(0)
+        idl = np.atleast_1d(np.asarray(idl, dtype=np.int64))
+        for name, val in (('center', center), ('normal', normal), ('radius', radius),
+                          ('material', material)):
+            if val is not None:
+                self.leaf[name][idl] = val
+        if center is not None or normal is not None or radius is not None:
+            self._refit(idl)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for k in self.arrays:
+            arr = self.bounds if k == 'bounds' else self.leaf[k]
+            np.save(os.path.join(path, k + '.npy'), np.ascontiguousarray(arr))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'version': SCENE_VERSION, 'key': self.key,
+                       'name': self.name, 'type': self.type}, f)
+        self.path = path
+
+    @classmethod
+    def load(cls, path, mmap = True):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != SCENE_VERSION:
+            raise ValueError(f'{path}: compiled scene version {meta["version"]}, '
+                             f'expected {SCENE_VERSION}')
+        mode = 'r' if mmap else None
+        arr = {k: np.load(os.path.join(path, k + '.npy'), mmap_mode=mode) for k in cls.arrays}
+        bounds = arr.pop('bounds')
+        return cls(meta['name'], meta['type'], bounds, arr, key=meta['key'], path=path)
+
+    def __getstate__(self):
+        if self.path is not None:
+            return {'mapped': self.path, 'grid': self.grid is not None, 'lod': self.lod()}
+        # the spare capacity of edited scenes is not sent
+        return dict(self.__dict__, _buf=None)
+
+    def __setstate__(self, state):
+        if 'mapped' in state:
+            scene = CompiledScene.load(state['mapped'])
+            if state['grid']:
+                scene.build_grid()
+            if state.get('lod') is not None:
+                scene.set_lod(*state['lod'])
+            state = scene.__dict__
+        self.__dict__.update(state)
+
+
+def compile_scene(scene, key = None):
+    # Packs a Scene (lists of per-bbox dicts) into a CompiledScene. Leaf disks may stick
+    # out of the bbox their generator gave them, so every bbox is grown to hold the disks
+    # of its leaves, as _refit does for edited leaves
+    leaf = pack_leaves(scene)
+    bounds = np.array(scene.bbox.bounds, dtype=float)
+    lo, hi = geometry.disk_aabb(leaf['normal'], leaf['center'], leaf['radius'])
+    np.minimum.at(bounds[:,0], leaf['bbox'], lo)
+    np.maximum.at(bounds[:,1], leaf['bbox'], hi)
+    return CompiledScene(scene.bbox.name, scene.bbox.type, bounds, leaf, key=key)
+
+
+def scene_key(params):
+    # Hash of the generation parameters identifying a cached scene
+    blob = json.dumps({'version': SCENE_VERSION, **params}, sort_keys=True)
+    return hashlib.sha1(blob.encode()).hexdigest()[:16]
+
+
+def load_scene(arg, grid = True):
+    # Default orchard scene from arg: scene_extent and optionally ntrees, nrows,
+    # leaves_shoot_half (leaf positions per shoot side, see tbar_canopy) and seed. With a
+    # seed and arg['scene_cache'] set, the compiled scene is stored in
+    # <scene_cache>/<key>/ on first use and memory-mapped from there afterwards
+    params = {'scene_extent': [float(x) for x in arg['scene_extent']],
+              'ntrees': arg.get('ntrees', 1),
+              'nrows': arg.get('nrows', 1),
+              'leaves_shoot_half': arg.get('leaves_shoot_half', 3),
+              'seed': arg.get('seed')}
+    key = scene_key(params)
+    cache = arg.get('scene_cache')
+    path = os.path.join(cache, key) if cache is not None else None
+
+    if path is not None and params['seed'] is not None and \
+            os.path.exists(os.path.join(path, 'meta.json')):
+        compiled = CompiledScene.load(path)
+    else:
+        rng = np.random.default_rng(params['seed'])
+        elements, junk = default_scene_elements(params['scene_extent'], ntrees=params['ntrees'],
+                            nrows=params['nrows'],
+                            leaves_shoot_half=params['leaves_shoot_half'], rng=rng)
+        scene = Scene()
+        scene.bbox.name   = elements['name']
+        scene.bbox.bounds = elements['bounds']
+        scene.bbox.type   = elements['type']
+        scene.bbox.leaf   = elements['canopy']
+        compiled = compile_scene(scene, key=key)
+        if path is not None and params['seed'] is not None:
+            compiled.save(path)
+
+    if grid:
+        compiled.build_grid()
+    return compiled
+
+
+def lod_bboxes(scene, arg, observer):
+    # Canopy bboxes to trace as turbid media: arg['lod_bboxes'] (bbox indices) and, with
+    # arg['lod_distance'], every bbox whose centre lies farther than that from the centre
+    # of the observer footprint, measured horizontally
+    boxes = list(arg.get('lod_bboxes', []))
+    if arg.get('lod_distance') is not None:
+        bounds = np.asarray(scene.bounds, dtype=float)
+        centre = bounds.mean(axis=1)[:,:2]
+        dist = np.linalg.norm(centre - np.asarray(observer['center'], dtype=float)[:2], axis=1)
+        far = (dist > arg['lod_distance']) & (np.asarray(scene.type) != 'scene')
+        boxes += list(np.flatnonzero(far))
+    return boxes
+
+
+class InstancedScene:
+    # Orchard made of instances of a few prototype canopies. Each prototype is a
+    # CompiledScene in its own local frame with its own acceleration grid, and instance k
+    # places prototype proto[k] at world = rotation[k] @ local + translation[k]. The leaf
+    # search transforms rays into instance space, so leaf geometry is stored once per
+    # prototype whatever the number of instances.
+    # Global leaf indices run over all instances (instance k owns leaf_offset[k]:
+    # leaf_offset[k+1]) so that tallies stay per leaf; the bbox index of instance k is k+1,
+    # bbox 0 being the scene boundaries as in CompiledScene. Instance k is tree k, and
+    # cane labels run over all instances too
+    def __init__(self, scene_extent, prototypes, proto, rotation, translation):
+        self.prototypes = prototypes
+        self.proto = np.asarray(proto, dtype=np.int64)
+        self.rotation = np.asarray(rotation, dtype=float)
+        self.translation = np.asarray(translation, dtype=float)
+        ni = len(self.proto)
+
+        # world AABB of every instance from the 8 corners of the box holding the leaf
+        # disks of its prototype
+        local = np.array([pr.leaf_bounds() for pr in prototypes])[self.proto]
+        corners = np.stack([np.stack([local[:,a,0], local[:,b,1], local[:,c,2]], axis=1)
+                            for a in (0,1) for b in (0,1) for c in (0,1)], axis=1)
+        world = np.einsum('kij,kcj->kci', self.rotation, corners) + self.translation[:,None,:]
+        self.bounds = np.concatenate([[[[0,0,0], scene_extent]],
+                                      np.stack([world.min(axis=1), world.max(axis=1)], axis=1)])
+        self.name = ['Boundaries'] + [f'instance_{k}' for k in range(ni)]
+        self.type = ['scene'] + ['instance']*ni
+
+        nl_proto = np.array([pr.nleaves for pr in prototypes])
+        self.leaf_offset = np.concatenate([[0], np.cumsum(nl_proto[self.proto])])
+        self._proto_offset = np.concatenate([[0], np.cumsum(nl_proto)])
+        self._normal = np.concatenate([pr.leaf['normal'] for pr in prototypes])
+        self._material = np.concatenate([pr.leaf['material'] for pr in prototypes])
+        self._center = np.concatenate([pr.leaf['center'] for pr in prototypes])
+        self._radius = np.concatenate([pr.leaf['radius'] for pr in prototypes])
+        self._cane = np.concatenate([pr.leaf['cane'] for pr in prototypes])
+        ncane = np.array([pr.leaf['cane'].max() + 1 if pr.nleaves > 0 else 0
+                          for pr in prototypes])
+        self.cane_offset = np.concatenate([[0], np.cumsum(ncane[self.proto])])
+
+    @property
+    def nleaves(self):
+        return int(self.leaf_offset[-1])
+
+    def _locate(self, idl):
+        inst = np.searchsorted(self.leaf_offset, idl, side='right') - 1
+        return inst, idl - self.leaf_offset[inst]
+
+    def leaf_normal(self, idl):
+        inst, local = self._locate(idl)
+        normal = self._normal[self._proto_offset[self.proto[inst]] + local]
+        return np.einsum('kij,kj->ki', self.rotation[inst], normal)
+
+    def leaf_bbox(self, idl):
+        return self._locate(idl)[0] + 1
+
+    def leaf_material(self, idl):
+        inst, local = self._locate(idl)
+        return self._material[self._proto_offset[self.proto[inst]] + local]
+
+    def leaf_tree(self, idl):
+        return self._locate(idl)[0]
+
+    def leaf_cane(self, idl):
+        inst, local = self._locate(idl)
+        cane = self._cane[self._proto_offset[self.proto[inst]] + local]
+        return np.where(cane >= 0, cane + self.cane_offset[inst], -1)
+
+    def leaf_center(self, idl):
+        inst, local = self._locate(idl)
+        center = self._center[self._proto_offset[self.proto[inst]] + local]
+        return np.einsum('kij,kj->ki', self.rotation[inst], center) + self.translation[inst]
+
+    def leaf_radius(self, idl):
+        inst, local = self._locate(idl)
+        return self._radius[self._proto_offset[self.proto[inst]] + local]
+
+    def content_hash(self):
+        # Hash of the prototypes, the instance transforms and the scene extent
+        h = hashlib.sha1(str(SCENE_VERSION).encode())
+        for pr in self.prototypes:
+            h.update(pr.content_hash().encode())
+        for arr in (self.proto, self.rotation, self.translation, self.bounds[0]):
+            h.update(np.ascontiguousarray(arr).tobytes())
+        return h.hexdigest()[:16]
+
+    def nearest_leaf(self, pos, direction, invdir, skip=None, one_sided=True, any_hit=False):
+        # Closest leaf along each ray. Rays are paired with the instances whose bounds they
+        # cross, moved into each instance's frame and traced through its prototype. With
+        # any_hit, rays that hit a leaf are not searched in further prototypes
+        t_best = np.full(len(pos), np.inf)
+        id_best = np.full(len(pos), -1, dtype=np.int64)
+        with instrument.phase('bbox_search'):
+            tmin, tmax = geometry.raybox_interval(pos, invdir, self.bounds[1:])
+            ray, inst = np.nonzero(tmax >= np.maximum(tmin, 0))
+        if instrument.enabled:
+            instrument.count('bbox_tests', tmin.size)
+            instrument.count('bbox_skipped', tmin.size - len(ray))
+
+        for ip, pr in enumerate(self.prototypes):
+            sel = self.proto[inst] == ip
+            if any_hit:
+                sel &= id_best[ray] < 0
+            if not np.any(sel):
+                continue
+            r, k = ray[sel], inst[sel]
+            rot = self.rotation[k]
+            o = np.einsum('kji,kj->ki', rot, pos[r] - self.translation[k])
+            d = np.einsum('kji,kj->ki', rot, direction[r])
+            s = None
+            if skip is not None:
+                s = skip[r] - self.leaf_offset[k]
+                s = np.where((s >= 0) & (s < pr.nleaves), s, -1)
+            with np.errstate(divide='ignore'):
+                t, il = pr.nearest_leaf(o, d, 1./d, skip=s, one_sided=one_sided,
+                                        any_hit=any_hit)
+            found = il >= 0
+            accel.reduce_nearest(r[found], t[found], self.leaf_offset[k[found]] + il[found],
+                                 t_best, id_best)
+        return t_best, id_best
+
+
+def prototype_canopy(width, height, rng, leaves_shoot_half = 3):
+    # Canopy of a (width x width x height) bbox in a local frame centred on the trunk base
+    local = [[-width/2., -width/2., 0], [width/2., width/2., height]]
+    leaf, cane = kiwi_tbar({'bounds': [local]}, 0, rng=rng,
+                           leaves_shoot_half=leaves_shoot_half)
+    scene = Scene()
+    scene.bbox.name   = ['prototype']
+    scene.bbox.type   = ['bbox']
+    scene.bbox.bounds = [local]
+    scene.bbox.leaf   = [leaf]
+    return compile_scene(scene)
+
+
+def instanced_scene(arg, grid = True):
+    # Default orchard layout (scene_extent, ntrees, nrows) filled with instances of
+    # arg['nprototypes'] (default 4) prototype canopies. Each tree picks a prototype at
+    # random and is rotated about its trunk: by 0 or 180 degrees if
+    # arg['instance_rotation'] is 'flip' (default, bboxes stay in the row), by any angle if
+    # it is 'free'
+    scene_extent = [float(x) for x in arg['scene_extent']]
+    ntrees = arg.get('ntrees', 1)
+    nrows = arg.get('nrows', 1)
+    rng = np.random.default_rng(arg.get('seed'))
+
+    b = np.array(canopy_bounds(scene_extent, ntrees, nrows, 0, 0))
+    prototypes = [prototype_canopy(b[1][0] - b[0][0], b[1][2] - b[0][2], rng,
+                                   leaves_shoot_half=arg.get('leaves_shoot_half', 3))
+                  for ip in range(arg.get('nprototypes', 4))]
+    if grid:
+        for pr in prototypes:
+            pr.build_grid()
+
+    centre = []
+    for i in range(ntrees):
+        for j in range(nrows):
+            b = np.array(canopy_bounds(scene_extent, ntrees, nrows, i, j))
+            centre.append([(b[0][0] + b[1][0])/2., (b[0][1] + b[1][1])/2., b[0][2]])
+    ni = len(centre)
+
+    if arg.get('instance_rotation', 'flip') == 'free':
+        angle = rng.uniform(0, 2*np.pi, ni)
+    else:
+        angle = np.pi*rng.integers(0, 2, ni)
+    rotation = np.zeros((ni,3,3))
+    rotation[:,0,0] = np.cos(angle)
+    rotation[:,0,1] = -np.sin(angle)
+    rotation[:,1,0] = np.sin(angle)
+    rotation[:,1,1] = np.cos(angle)
+    rotation[:,2,2] = 1
+
+    return InstancedScene(scene_extent, prototypes, rng.integers(0, len(prototypes), ni),
+                          rotation, centre)
+
+
+def default_scene_elements(scene_extent, ntrees = 1, nrows = 1, leaves_shoot_half = 3,
+                           rng = None):
+    # rng: numpy Generator used for the leaf geometry, global np.random if None;
+    # leaves_shoot_half sets the leaf density (see tbar_canopy)
     
     bboxes ={
             'name': [],
@@ -40,166 +593,136 @@ def default_scene_elements(scene_extent):
     # Bounding boxes go here
 
 
-    ntrees = 1
-    nrows  = 1
-    
-    ax_al  = 0 # canopy aligned along axis ax_al
-
-    cwidth = scene_extent[ax_al]/(ntrees*1.1)
-#    twidth = scene_extent[ax_al]/(10.0*ntrees)
-
-    gapx = scene_extent[ax_al] - cwidth*ntrees
-
-    cgaps = gapx/ntrees 
-    
-    ibb = 1
+    # all canopies are generated together, then split per bbox
+    bounds = [canopy_bounds(scene_extent, ntrees, nrows, i, j)
+              for i in range(ntrees) for j in range(nrows)]
+    leaf, cane = tbar_canopy(bounds, rng=rng, leaves_shoot_half=leaves_shoot_half)
+    lsplit = np.searchsorted(leaf['tree'], np.arange(len(bounds) + 1))
+    csplit = np.searchsorted(cane['tree'], np.arange(len(bounds) + 1))
+    ssplit = np.searchsorted(cane['shoot_tree'], np.arange(len(bounds) + 1))
 
     cane_list = []
-
-    for i in range(ntrees):
-        for j in range(nrows):
-            # canopy
-            bboxes['name'].append(f'canopy_{i}.{j}')
-            bboxes['type'].append('bbox')
-            bboxes['bounds'].append([[(cgaps + cwidth)*(0.5+i)-cwidth/2., 
-                                        (scene_extent[1]/2.-cwidth/2.) - (2*j-(nrows-1))*cwidth*.75 ,
-                                        0],
-                                    [(cgaps+cwidth)*(0.5+i)+cwidth/2., 
-                                        scene_extent[1]/2.+cwidth/2. - (2*j-(nrows-1))*cwidth*.75,
-                                        scene_extent[2]*3/5.]])
-            
-            leaf, cane = kiwi_tbar(bboxes,ibb)
-            cane_list.append(cane)
-            bboxes['canopy'].append(leaf)
-            
-            """            # trunk
-            bboxes['name'].append(f'trunk_{i}.{j}')
-            bboxes['type'].append('bbox')
-            bboxes['bounds'].append([[(cwidth+cgaps)*(0.5+i) - twidth/2., 
-                                        scene_extent[1]/2.-twidth/2. - (2*j-(nrows-1))*cwidth*.75,
-                                        0],
-                                      [(cwidth+cgaps)*(0.5+i) + twidth/2., 
-                                        scene_extent[1]/2.+twidth/2. - (2*j-(nrows-1))*cwidth*.75,
-                                        scene_extent[2]*1./5]])
-                
-            
-
-            bboxes['canopy'].append([]) 
-            """
-            
-            ibb += 1
-            
-
+    for k, (i, j) in enumerate((i, j) for i in range(ntrees) for j in range(nrows)):
+        bboxes['name'].append(f'canopy_{i}.{j}')
+        bboxes['type'].append('bbox')
+        bboxes['bounds'].append(bounds[k])
+        bboxes['canopy'].append({name: val[lsplit[k]:lsplit[k+1]] for name, val in leaf.items()})
+        cane_list.append({'trunk_pos': cane['trunk_pos'][k],
+                          'lead_pos': cane['lead_pos'][k],
+                          'cane_pos': cane['cane_pos'][csplit[k]:csplit[k+1]],
+                          'shoot_pos': cane['shoot_pos'][ssplit[k]:ssplit[k+1]]})
 
     return bboxes, cane_list
 
 
-def lad_0():
-    return np.random.normal(0,np.pi/8.)
-
-
-def kiwi_tbar(bboxes, ibb, nleaves = 100, lad = lad_0):
-    # Constructs a T-bar kiwifruit structure within bounding box ibb
+def canopy_bounds(scene_extent, ntrees, nrows, i, j):
+    # Bounding box of tree i in row j of the default orchard layout
+    ax_al  = 0 # canopy aligned along axis ax_al
 
+    cwidth = scene_extent[ax_al]/(ntrees*1.1)
+#    twidth = scene_extent[ax_al]/(10.0*ntrees)
 
-    cane_sep = 40.0 # cane separation
-    bar_height = 85.0 # height of structure
+    gapx = scene_extent[ax_al] - cwidth*ntrees
 
-    bbox_pos = bboxes['bounds'][ibb]
+    cgaps = gapx/ntrees 
 
-    bb_sizex = bbox_pos[1][0] - bbox_pos[0][0]
-    bb_sizey = bbox_pos[1][1] - bbox_pos[0][1]
-    
-    cane_length0 = bb_sizey
-    ncanes       = int(bb_sizex/cane_sep)
-    coff         = bb_sizex - cane_sep*ncanes 
-    nshoots_avg  = 10
-    shoot_size   = cane_sep
-    lead_pos     = bb_sizey/2.
-    leaf = {}
-    leaf['center'] = []
-    leaf['radius'] = []
-    leaf['normal'] = []
-    
-    cane = {}
-    cane['cane_pos'] = []
-    cane['shoot_pos'] = []
-    cane['trunk_pos'] = [[(bbox_pos[0][0] + bbox_pos[1][0])/2.,
-                         (bbox_pos[0][1] + bbox_pos[1][1])/2.,
-                         0],
-                         [(bbox_pos[0][0] + bbox_pos[1][0])/2.,
-                         (bbox_pos[0][1] + bbox_pos[1][1])/2.,
-                         bar_height]]
-    cane['lead_pos'] = [[bbox_pos[0][0], (bbox_pos[0][1] + bbox_pos[1][1])/2.,
-                        bar_height],
-                        [bbox_pos[1][0], (bbox_pos[0][1] + bbox_pos[1][1])/2.,
-                        bar_height]]
-
-
-
-
-
-#    import pdb ; pdb.set_trace()
-
-    kl = 0 # leaf counter
-    for ic in range(ncanes):
-        pos_cane = coff/2. + bbox_pos[0][0] + ic*cane_sep  + np.random.normal(0.0,2.0)
-#        print (f'cane position x {pos_cane}')
-        # canes have different shoots in both sides wrt the main lead
-        nshoots = int(nshoots_avg + np.random.uniform(0.0,5))
-        if nshoots < 1:
-            nshoots = 1
-        cane['cane_pos'].append([[pos_cane, bbox_pos[0][1], bar_height],
-                                 [pos_cane, bbox_pos[1][1], bar_height]])
-
-        
-        for ish in range(nshoots):
-#            sign = 1 if np.random.random() < 0.5 else -1
-#            print (f'sign {sign}')
-            #spos = np.random.uniform(0,cane_length0)
-            sign = 1
-            spos = int(cane_length0/nshoots)*ish + np.random.uniform(0,10)
-#            print (f'shoot position y {spos}')
-            ssize = shoot_size/2. + np.random.uniform(0.0, shoot_size/4.)
-#            print (f'shoot size x {ssize}')
-            leaves_shoot_half = int(3)# + np.random.normal(0.0, 2))
-            if leaves_shoot_half < 1:
-                leaves_shoot_half = 1
-
-            lsep = int(ssize/leaves_shoot_half)
-            loff = ssize - lsep*leaves_shoot_half
-
-            cane['shoot_pos'].append([[pos_cane - ssize, spos + bbox_pos[0][1], bar_height],
-                                      [pos_cane + ssize, spos + bbox_pos[0][1], bar_height]])
-
-            for iss in [-1,1]:
-                for il in range(leaves_shoot_half):
-                    leaf_rad = 5.0  + np.random.uniform(-.5,.5)
-                    lpos = loff/2. + lsep*il + np.random.normal(0.0,2)
-
-                    clx = pos_cane + lpos*iss
-                    cly = bbox_pos[0][1]+spos
-
-                    if (clx < bbox_pos[1][0] and clx > bbox_pos[0][0]) and (
-                            cly < bbox_pos[1][1] and cly > bbox_pos[0][1]):
-                        
-                        leaf['center'].append([pos_cane + lpos*iss, 
-                            bbox_pos[0][1] + spos - leaf_rad, bar_height])
-                        leaf['radius'].append(leaf_rad)
-                        leaf['normal'].append(geometry.dir_vector(lad_0(), 2*np.pi*np.random.uniform()))
-                        leaf['center'].append([pos_cane + lpos*iss, 
-                            bbox_pos[0][1] + spos + leaf_rad, bar_height])
-                        leaf['radius'].append(leaf_rad)
-                        leaf['normal'].append(geometry.dir_vector(lad_0(), 2*np.pi*np.random.uniform()))
-
-#                    print (f'leaf data {leaf}')
-
-            kl += 2
-                
-#                import pdb ; pdb.set_trace()
-
-#    print (f'Number of leaves {kl}')
+    return [[(cgaps + cwidth)*(0.5+i)-cwidth/2., 
+                (scene_extent[1]/2.-cwidth/2.) - (2*j-(nrows-1))*cwidth*.75 ,
+                0],
+            [(cgaps+cwidth)*(0.5+i)+cwidth/2., 
+                scene_extent[1]/2.+cwidth/2. - (2*j-(nrows-1))*cwidth*.75,
+                scene_extent[2]*3/5.]]
+
+
+def lad_0(rng = np.random, size = None):
+    # Leaf zenith angle distribution: normal around horizontal leaves
+    return rng.normal(0,np.pi/8., size)
+
+
+def tbar_canopy(bounds, rng = None, lad = lad_0, cane_sep = 40.0, bar_height = 85.0,
+                nshoots_avg = 10, leaves_shoot_half = 3, leaf_radius = 5.0):
+    # T-bar kiwifruit canopies inside every bbox of bounds (nbb,2,3), generated for all of
+    # them at once: canes, shoots and leaf slots are drawn as arrays level by level from
+    # rng (a numpy Generator, global np.random if None), so any number of trees costs a
+    # few vectorised operations and a given Generator state always gives the same scene.
+    # Canes run along y every cane_sep along x, each with nshoots_avg..nshoots_avg+4
+    # shoots; each shoot has leaves_shoot_half leaf positions on either side of the cane,
+    # and each position kept inside the bbox holds a pair of leaves.
+    # Returns a leaf dict of arrays (center, normal, radius, material and the tree, cane
+    # and shoot each leaf grows on) and a cane dict of segment arrays (trunk_pos,
+    # lead_pos, cane_pos, shoot_pos, shape (n,2,3)) with the tree of every cane and shoot
+    if rng is None:
+        rng = np.random
+    bounds = np.asarray(bounds, dtype=float).reshape(-1,2,3)
+    lo, hi = bounds[:,0], bounds[:,1]
+    size = hi - lo
+    mid = (lo + hi)/2.
+
+    # canes
+    ncanes = (size[:,0]/cane_sep).astype(np.int64)
+    coff = size[:,0] - cane_sep*ncanes
+    tree = np.repeat(np.arange(len(bounds)), ncanes)
+    ic = np.arange(len(tree)) - np.repeat(np.cumsum(ncanes) - ncanes, ncanes)
+    pos_cane = coff[tree]/2. + lo[tree,0] + ic*cane_sep + rng.normal(0.0, 2.0, len(tree))
+    nshoots = np.maximum((nshoots_avg + rng.uniform(0.0, 5, len(tree))).astype(np.int64), 1)
+
+    # shoots
+    cs = np.repeat(np.arange(len(tree)), nshoots)
+    ts = tree[cs]
+    ish = np.arange(len(cs)) - np.repeat(np.cumsum(nshoots) - nshoots, nshoots)
+    spos = (size[ts,1]/nshoots[cs]).astype(np.int64)*ish + rng.uniform(0, 10, len(cs))
+    ssize = cane_sep/2. + rng.uniform(0.0, cane_sep/4., len(cs))
+    lsep = (ssize/leaves_shoot_half).astype(np.int64)
+    loff = ssize - lsep*leaves_shoot_half
+
+    # leaf positions: leaves_shoot_half on each side of every shoot
+    nslot = 2*leaves_shoot_half
+    ss = np.repeat(np.arange(len(cs)), nslot)
+    k = np.tile(np.arange(nslot), len(cs))
+    iss = np.where(k < leaves_shoot_half, -1, 1)
+    il = k % leaves_shoot_half
+    leaf_rad = leaf_radius + rng.uniform(-.5, .5, len(ss))
+    lpos = loff[ss]/2. + lsep[ss]*il + rng.normal(0.0, 2, len(ss))
+    t = ts[ss]
+    clx = pos_cane[cs[ss]] + lpos*iss
+    cly = lo[t,1] + spos[ss]
+    keep = (clx < hi[t,0]) & (clx > lo[t,0]) & (cly < hi[t,1]) & (cly > lo[t,1])
+    ss, t, clx, cly, leaf_rad = ss[keep], t[keep], clx[keep], cly[keep], leaf_rad[keep]
+
+    # two leaves per position, either side of the shoot
+    n = 2*len(ss)
+    side = np.tile([-1., 1.], len(ss))
+    rad = np.repeat(leaf_rad, 2)
+    center = np.stack([np.repeat(clx, 2), np.repeat(cly, 2) + side*rad,
+                       np.full(n, bar_height)], axis=1)
+    normal = geometry.dir_vector(lad(rng, size=n), 2*np.pi*rng.uniform(size=n)).T
+
+    leaf = {'center': center,
+            'normal': np.ascontiguousarray(normal),
+            'radius': rad,
+            'material': np.zeros(n, dtype=np.int64),
+            'tree': np.repeat(t, 2),
+            'cane': np.repeat(cs[ss], 2),
+            'shoot': np.repeat(ss, 2)}
+
+    def segments(x0, y0, x1, y1, z0, z1):
+        return np.stack([np.stack([x0, y0, z0], axis=1), np.stack([x1, y1, z1], axis=1)],
+                        axis=1)
+    bar = np.full(len(bounds), bar_height)
+    cane = {'tree': tree,
+            'shoot_tree': ts,
+            'trunk_pos': segments(mid[:,0], mid[:,1], mid[:,0], mid[:,1], 0*bar, bar),
+            'lead_pos': segments(lo[:,0], mid[:,1], hi[:,0], mid[:,1], bar, bar),
+            'cane_pos': segments(pos_cane, lo[tree,1], pos_cane, hi[tree,1],
+                                 np.full(len(tree), bar_height), np.full(len(tree), bar_height)),
+            'shoot_pos': segments(pos_cane[cs] - ssize, spos + lo[ts,1], pos_cane[cs] + ssize,
+                                  spos + lo[ts,1], np.full(len(cs), bar_height),
+                                  np.full(len(cs), bar_height))}
     return leaf, cane
-                
 
 
+def kiwi_tbar(bboxes, ibb, nleaves = 100, lad = lad_0, rng = None, leaves_shoot_half = 3):
+    # Constructs a T-bar kiwifruit structure within bounding box ibb (see tbar_canopy).
+    # nleaves is unused: the leaf count follows from leaves_shoot_half
+    return tbar_canopy([bboxes['bounds'][ibb]], rng=rng, lad=lad,
+                       leaves_shoot_half=leaves_shoot_half)
@@ -0,0 +1,142 @@
+# Direct-sun visibility by shadow rays.
+# First-order questions (which leaves, and how much ground, the sun sees) do not need the
+# multi-bounce tracer: one shadow ray towards the sun per sample point on every leaf and
+# per ground cell answers them. Shadow rays use the any-hit leaf search, so a ray stops
+# at the first blocking leaf it finds instead of looking for the closest one.
+# plantrt.run_direct wraps this for a run configuration.
+
+import numpy as np
+import geometry
+import instrument
+
+
+def sun_direction(theta_sun, phi_sun):
+    # Unit vector towards the sun; source photons travel along dir_vector(theta_sun +
+    # pi/2, phi_sun), i.e. theta_sun is the solar elevation
+    return -geometry.dir_vector(theta_sun + np.pi/2., phi_sun)
+
+
+def disk_samples(center, normal, radius, nsamples, rng):
+    # nsamples points on each disk, (m*nsamples, 3) with the samples of a disk contiguous,
+    # uniform over the disk area. A single sample is the disk centre
+    m = len(radius)
+    if nsamples == 1:
+        return np.asarray(center, dtype=float).copy()
+    u, v = geometry.disk_basis(normal)
+    r = np.sqrt(rng.random((m, nsamples)))*np.asarray(radius, dtype=float)[:,None]
+    ang = 2*np.pi*rng.random((m, nsamples))
+    p = np.asarray(center, dtype=float)[:,None,:] + \
+        (r*np.cos(ang))[:,:,None]*u[:,None,:] + (r*np.sin(ang))[:,:,None]*v[:,None,:]
+    return p.reshape(-1, 3)
+
+
+def periodic_axes(arg):
+    # arg['periodic'] names the axes with wrap-around boundaries: 'x', 'y', 'xy' or a list
+    # of axis indices (0, 1). Returns a bool mask over x, y, z
+    periodic = arg.get('periodic') or ()
+    axes = ['xyz'.index(a) for a in periodic] if isinstance(periodic, str) else list(periodic)
+    if 2 in axes:
+        raise ValueError('periodic boundaries are only supported along x and y')
+    mask = np.zeros(3, dtype=bool)
+    mask[axes] = True
+    return mask
+
+
+def cast(scene, pos, direction, scene_extent, skip = None, periodic = None, max_walls = 64,
+         one_sided = True, any_hit = False):
+    # Follows rays until they hit a leaf or reach the top or the ground of the scene. Like
+    # the tracer's photons, a ray reaching a side wall goes on through it: wrapped around
+    # on the axes flagged in periodic, mirrored otherwise. direction is one vector or one
+    # per ray. Returns the leaf hit (-1 if none), the point reached (on the leaf or the
+    # wall), the direction of the last segment and the axis of the last wall reached
+    # (2 for the top or the ground, 0 or 1 for rays stopped after max_walls side walls)
+    scene_extent = np.asarray(scene_extent, dtype=float)
+    n = len(pos)
+    ids = np.full(n, -1, dtype=np.int64)
+    axis = np.full(n, 2, dtype=np.int64)
+    p = np.array(pos, dtype=float)
+    d = np.array(np.broadcast_to(np.asarray(direction, dtype=float), (n, 3)))
+    s = np.full(n, -1, dtype=np.int64) if skip is None else np.asarray(skip, dtype=np.int64)
+    ray = np.arange(n)
+
+    for iwall in range(max_walls + 1):
+        with np.errstate(divide='ignore'):
+            invdir = 1./d[ray]
+        t, il = scene.nearest_leaf(p[ray], d[ray], invdir, skip=s, one_sided=one_sided,
+                                   any_hit=any_hit)
+        hit = il >= 0
+        ids[ray[hit]] = il[hit]
+        p[ray[hit]] += t[hit,None]*d[ray[hit]]
+
+        # rays hitting no leaf go to the wall they leave through
+        free = ray[~hit]
+        tw, ax = geometry.wall_distance(p[free], invdir[~hit], scene_extent)
+        p[free] += tw[:,None]*d[free]
+        axis[free] = ax
+        if iwall == max_walls:
+            break
+
+        # and carry on through the side walls
+        side = ax != 2
+        ray, ax = free[side], ax[side]
+        wrap = np.zeros(len(ray), dtype=bool) if periodic is None else periodic[ax]
+        p[ray[wrap], ax[wrap]] = np.where(d[ray[wrap], ax[wrap]] > 0, 0.,
+                                          scene_extent[ax[wrap]])
+        d[ray[~wrap], ax[~wrap]] *= -1
+        s = np.full(len(ray), -1, dtype=np.int64)
+        if len(ray) == 0:
+            break
+    return ids, p, d, axis
+
+
+def visible(scene, pos, sun, scene_extent, skip = None, periodic = None, max_walls = 64):
+    # Whether the sun (a unit vector towards it, or one per point) is seen from each
+    # point, i.e. the shadow ray towards it hits no leaf (from either side) before leaving
+    # through the top of the scene, going through the side walls as in cast. Rays still
+    # inside after max_walls walls are counted as visible. Turbid bboxes
+    # (CompiledScene.set_lod) cast no shadow
+    ids = cast(scene, pos, sun, scene_extent, skip, periodic, max_walls, one_sided=False,
+               any_hit=True)[0]
+    if instrument.enabled:
+        instrument.count('shadow_rays', len(pos))
+    return ids < 0
+
+
+def leaf_sunlit(scene, sun, scene_extent, nsamples = 4, rng = None, periodic = None):
+    # Per leaf: the fraction of its sample points that see the sun (0 for leaves facing
+    # away from it, which the tracer's one-sided leaves would not intercept) and the
+    # cosine of the sun's incidence angle
+    if rng is None:
+        rng = np.random.default_rng()
+    idl = np.arange(scene.nleaves)
+    normal = scene.leaf_normal(idl)
+    cos = normal @ np.asarray(sun, dtype=float)/np.linalg.norm(normal, axis=1)
+    front = np.flatnonzero((cos > 0) & (scene.leaf_radius(idl) > 0))
+    pts = disk_samples(scene.leaf_center(front), normal[front], scene.leaf_radius(front),
+                       nsamples, rng)
+    lit = visible(scene, pts, sun, scene_extent, skip=np.repeat(front, nsamples),
+                  periodic=periodic)
+    frac = np.zeros(scene.nleaves)
+    frac[front] = lit.reshape(-1, nsamples).mean(axis=1)
+    return frac, np.maximum(cos, 0)
+
+
+def ground_sunlit(scene, sun, scene_extent, bins = (50,50), nsamples = 1, rng = None,
+                  periodic = None):
+    # Fraction of the sample points of every ground cell (bins over the scene footprint,
+    # as Tallies.ground) that see the sun; one sample is the cell centre
+    if rng is None:
+        rng = np.random.default_rng()
+    scene_extent = np.asarray(scene_extent, dtype=float)
+    ii, jj = np.meshgrid(np.arange(bins[0]), np.arange(bins[1]), indexing='ij')
+    ii = np.repeat(ii.ravel(), nsamples)
+    jj = np.repeat(jj.ravel(), nsamples)
+    if nsamples == 1:
+        du = dv = np.full(len(ii), 0.5)
+    else:
+        du, dv = rng.random(len(ii)), rng.random(len(ii))
+    pos = np.zeros((len(ii), 3))
+    pos[:,0] = (ii + du)/bins[0]*scene_extent[0]
+    pos[:,1] = (jj + dv)/bins[1]*scene_extent[1]
+    lit = visible(scene, pos, sun, scene_extent, periodic=periodic)
+    return lit.reshape(tuple(bins) + (nsamples,)).mean(axis=2)
@@ -0,0 +1,174 @@
+# Streaming tallies for the batch tracer.
+# All accumulators have a fixed size set by the scene and are updated in place as photons
+# move, so memory does not grow with the number of photons traced.
+
+import numpy as np
+
+
+class RunningStat:
+    # Running mean and variance (Welford). Samples are added in batches and two
+    # RunningStat objects can be merged exactly (Chan et al. pairwise update)
+    def __init__(self, shape=()):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def _combine(self, n, mean, m2):
+        if n == 0:
+            return
+        ntot = self.n + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta*n/ntot
+        self.m2 = self.m2 + m2 + delta**2*self.n*n/ntot
+        self.n = ntot
+
+    def update(self, x):
+        # x: array of samples along the first axis
+        x = np.asarray(x, dtype=float)
+        if len(x) == 0:
+            return
+        mean = x.mean(axis=0)
+        self._combine(len(x), mean, np.sum((x - mean)**2, axis=0))
+
+    def merge(self, other):
+        self._combine(other.n, other.mean, other.m2)
+
+    @property
+    def var(self):
+        return self.m2/(self.n - 1) if self.n > 1 else np.zeros_like(self.mean)
+
+    @property
+    def sem(self):
+        # standard error of the mean
+        return np.sqrt(self.var/self.n) if self.n > 0 else np.zeros_like(self.mean)
+
+
+class Tallies:
+    # Fixed-size accumulators updated by the tracer:
+    #   leaf_hits, leaf_flux, leaf_absorbed : per leaf (global leaf index)
+    #   leaf_direct : the part of leaf_flux that is unscattered sunlight
+    #   ground : flux reaching z = 0, on a grid over the scene footprint
+    #   image  : flux crossing the observer plane towards the sensor, on a pixel grid
+    #   escape : flux reaching the top of the scene, binned in outgoing (theta, phi)
+    #   stats  : per source photon RunningStat of leaf hits and path length
+    # With nbands > 0 (spectral runs) weights are (k,nbands) arrays and every flux tally
+    # gets a trailing band axis, so one path updates all bands at once
+    fields = ('leaf_hits', 'leaf_flux', 'leaf_direct', 'leaf_absorbed', 'ground', 'image',
+              'escape')
+
+    def __init__(self, nleaves, scene_extent, observer, ground_bins=(50,50),
+                 image_bins=(32,32), escape_bins=(9,18), nbands=0):
+        self.scene_extent = np.asarray(scene_extent, dtype=float)
+        self.nsource = 0
+        self.nbands = nbands
+        band = (nbands,) if nbands else ()
+        self.leaf_hits = np.zeros(nleaves, dtype=np.int64)
+        self.leaf_flux = np.zeros((nleaves,) + band)
+        self.leaf_direct = np.zeros((nleaves,) + band)
+        self.leaf_absorbed = np.zeros((nleaves,) + band)
+        self.ground = np.zeros(tuple(ground_bins) + band)
+        self.image = np.zeros(tuple(image_bins) + band)
+        self.escape = np.zeros(tuple(escape_bins) + band)
+        self.stats = {'leaf_hits': RunningStat(), 'path_length': RunningStat()}
+
+        # the observer plane is perpendicular to the dominant axis of its normal and the
+        # image spans its extent along the other two axes
+        self.obs_center = np.asarray(observer['center'], dtype=float)
+        self.obs_normal = np.asarray(observer['normal'], dtype=float)
+        self.obs_axis = int(np.argmax(np.abs(self.obs_normal)))
+        self.obs_uv = [x for x in range(3) if x != self.obs_axis]
+        self.obs_extent = np.asarray(observer['extent'], dtype=float)[self.obs_uv]
+
+    @classmethod
+    def for_scene(cls, arg, nleaves, observer, nbands = 0):
+        # bin counts can be set through arg['ground_bins'], ['image_bins'], ['escape_bins']
+        kw = {k: arg[k] for k in ('ground_bins', 'image_bins', 'escape_bins') if k in arg}
+        return cls(nleaves, arg['scene_extent'], observer, nbands=nbands, **kw)
+
+
+    def add_leaf(self, idl, weight, absorbed, direct = None):
+        # direct: optional mask of the hits made by unscattered sunlight
+        nl = len(self.leaf_hits)
+        self.leaf_hits += np.bincount(idl, minlength=nl)
+        self.leaf_flux += _bincount(idl, weight, nl)
+        self.leaf_absorbed += _bincount(idl, absorbed, nl)
+        if direct is not None:
+            self.leaf_direct += _bincount(idl[direct], weight[direct], nl)
+
+    def add_ground(self, pos, weight):
+        self.ground += _hist2d(pos[:,0]/self.scene_extent[0], pos[:,1]/self.scene_extent[1],
+                               weight, self.ground.shape[:2])
+
+    def add_escape(self, direction, weight):
+        theta = np.arccos(np.clip(direction[:,2], -1, 1))/(np.pi/2.)
+        phi = np.mod(np.arctan2(direction[:,1], direction[:,0]), 2*np.pi)/(2*np.pi)
+        self.escape += _hist2d(theta, phi, weight, self.escape.shape[:2])
+
+    def add_crossing(self, p0, p1, weight):
+        # Records path segments p0 -> p1 that cross the observer plane travelling towards
+        # the sensor (against its viewing normal) inside its extent
+        k = self.obs_axis
+        dz = p1[:,k] - p0[:,k]
+        towards = dz*self.obs_normal[k] < 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s = (self.obs_center[k] - p0[:,k])/dz
+        sel = towards & (s > 0) & (s <= 1)
+        if not np.any(sel):
+            return
+        x = p0[sel] + s[sel,None]*(p1[sel] - p0[sel])
+        uv = (x[:,self.obs_uv] - self.obs_center[self.obs_uv])/self.obs_extent + 0.5
+        self.image += _hist2d(uv[:,0], uv[:,1], weight[sel], self.image.shape[:2])
+
+    def add_sources(self, nhits, path_length):
+        # per source photon totals, summed over all its branches
+        self.nsource += len(nhits)
+        self.stats['leaf_hits'].update(nhits)
+        self.stats['path_length'].update(path_length)
+
+
+    def totals(self):
+        # Flux per source photon of the main tallies, summed over leaves or bins
+        # (per band in spectral runs)
+        n = max(self.nsource, 1)
+        return {name: getattr(self, name).reshape(
+                    (-1, self.nbands) if self.nbands else -1).sum(axis=0)/n
+                for name in ('leaf_flux', 'leaf_absorbed', 'ground', 'image', 'escape')}
+
+    def merge(self, other):
+        self.nsource += other.nsource
+        for name in self.fields:
+            getattr(self, name)[...] += getattr(other, name)
+        for name in self.stats:
+            self.stats[name].merge(other.stats[name])
+        return self
+
+
+def stack(tallies):
+    # Stacks the tallies of several configurations (e.g. a sun sweep) along a new first
+    # axis: one array per Tallies field, nsource, and the mean and sem of every stat
+    out = {name: np.stack([getattr(t, name) for t in tallies]) for name in Tallies.fields}
+    out['nsource'] = np.array([t.nsource for t in tallies])
+    for name in tallies[0].stats:
+        out[name + '_mean'] = np.array([t.stats[name].mean for t in tallies])
+        out[name + '_sem'] = np.array([t.stats[name].sem for t in tallies])
+    return out
+
+
+def _bincount(idx, weight, n):
+    # np.bincount for weights of shape (k,) or (k,nbands)
+    if weight.ndim == 1:
+        return np.bincount(idx, weights=weight, minlength=n)
+    return np.stack([np.bincount(idx, weights=w, minlength=n) for w in weight.T], axis=1)
+
+
+def _hist2d(u, v, weight, shape):
+    # Weighted histogram of points with coordinates u, v in [0,1); points outside are dropped.
+    # Spectral weights (k,nbands) give a (shape + (nbands,)) histogram
+    iu = np.floor(u*shape[0]).astype(np.int64)
+    iv = np.floor(v*shape[1]).astype(np.int64)
+    # points exactly on the upper edge belong to the last bin
+    iu[u == 1] = shape[0] - 1
+    iv[v == 1] = shape[1] - 1
+    ok = (iu >= 0) & (iu < shape[0]) & (iv >= 0) & (iv < shape[1])
+    flat = _bincount(iu[ok]*shape[1] + iv[ok], weight[ok], shape[0]*shape[1])
+    return flat.reshape(tuple(shape) + flat.shape[1:])
@@ -0,0 +1,40 @@
+import numpy as np
+import benchmark
+import geometry
+import scene_conf
+
+
+def test_grid_matches_bbox_search():
+    # Leaf disks sticking out of their generator bbox are found by the bbox search too:
+    # rays grazing the protruding part of a leaf get the same hit from both searches
+    arg = benchmark.scene_arg(2, 2)
+    by_bbox = scene_conf.load_scene(arg, grid=False)
+    by_grid = scene_conf.load_scene(arg)
+
+    # the leaf sticking out farthest past its canopy bbox as generated, and the way out
+    leaf = by_bbox.leaf
+    bounds = np.array([scene_conf.canopy_bounds(arg['scene_extent'], 2, 2, i, j)
+                       for i in range(2) for j in range(2)])[leaf['bbox'] - 1]
+    lo, hi = geometry.disk_aabb(leaf['normal'], leaf['center'], leaf['radius'])
+    out = np.concatenate([bounds[:,0] - lo, hi - bounds[:,1]], axis=1)
+    idl, face = np.unravel_index(np.argmax(out), out.shape)
+    assert out[idl, face] > 0
+    outward = np.zeros(3)
+    outward[face % 3] = 1. if face >= 3 else -1.
+
+    # rays towards its front face through points just inside its protruding edge
+    n = leaf['normal'][idl]/np.linalg.norm(leaf['normal'][idl])
+    up = outward - (outward @ n)*n
+    up /= np.linalg.norm(up)
+    side = np.cross(n, up)
+    s = np.linspace(-0.3, 0.3, 7)
+    pts = leaf['center'][idl] + leaf['radius'][idl]*(0.95*up + s[:,None]*side)
+    pos = pts + 5*n
+    direction = np.tile(-n, (len(pos), 1))
+    invdir = 1./direction
+
+    t_bbox, id_bbox = by_bbox.nearest_leaf(pos, direction, invdir)
+    t_grid, id_grid = by_grid.nearest_leaf(pos, direction, invdir)
+    assert np.all(id_bbox >= 0)
+    np.testing.assert_array_equal(id_bbox, id_grid)
+    np.testing.assert_allclose(t_bbox, t_grid)
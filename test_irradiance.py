@@ -0,0 +1,18 @@
+import numpy as np
+import benchmark
+import irradiance
+
+
+def test_absorbed_by_cane_and_tree():
+    # Compiled scenes keep the tree and cane of every leaf, so absorbed power can be
+    # summed per cane or per tree straight from the cached irradiance
+    arg = benchmark.scene_arg(2, 2, nscat=3)
+    arg.update(nphotons=2000, leaf_absorptance=0.8)
+    irr = irradiance.leaf_irradiance(arg, cache=irradiance.IrradianceCache())
+    per_tree = irr.absorbed_by('tree')
+    per_cane = irr.absorbed_by('cane')
+    assert len(per_tree) == 4
+    assert len(per_cane) > len(per_tree)
+    total = np.sum(irr.absorbed*irr.area)
+    np.testing.assert_allclose(per_tree.sum(), total)
+    np.testing.assert_allclose(per_cane.sum(), total)
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+import benchmark
+import plantrt
+import scene_conf
+
+
+def _block(tile, arg, n):
+    # n x n copies of the canopies of a compiled tile, side by side
+    extent = np.asarray(arg['scene_extent'], dtype=float)
+    scene = scene_conf.Scene()
+    scene.bbox.name = ['Boundaries']
+    scene.bbox.type = ['scene']
+    scene.bbox.bounds = [[[0,0,0], [n*extent[0], n*extent[1], extent[2]]]]
+    scene.bbox.leaf = [[]]
+    off = tile.leaf['offset']
+    for i in range(n):
+        for j in range(n):
+            shift = np.array([i*extent[0], j*extent[1], 0.])
+            for ibb in range(1, len(tile.bounds)):
+                ids = np.arange(off[ibb], off[ibb+1])
+                scene.bbox.name.append(f'{tile.name[ibb]}_{i}.{j}')
+                scene.bbox.type.append(tile.type[ibb])
+                scene.bbox.bounds.append(tile.bounds[ibb] + shift)
+                scene.bbox.leaf.append({'center': tile.leaf['center'][ids] + shift,
+                                        'normal': tile.leaf['normal'][ids],
+                                        'radius': tile.leaf['radius'][ids]})
+    return scene
+
+
+def test_periodic_tile_matches_block():
+    # A periodic tile and a periodic block of 3x3 copies of it are the same infinite
+    # orchard, so they intercept the same light per source photon however many side
+    # walls photons cross
+    arg = benchmark.scene_arg(1, 1, nscat=3, nplevels=0)
+    arg.update(nphotons=20000, periodic='xy')
+    tile = scene_conf.load_scene(arg)
+    block_arg = dict(arg, scene_extent=[3*x for x in arg['scene_extent'][:2]] +
+                     [arg['scene_extent'][2]])
+    block_arg['observer'] = dict(arg['observer'], center=[300., 450., 150.])
+    block = plantrt.compiled_scene(block_arg, _block(tile, arg, 3))
+
+    t_tile = plantrt.run_batch(arg, scene=tile)[3]
+    t_block = plantrt.run_batch(block_arg, scene=block, rng=np.random.default_rng(1))[3]
+    hits_tile = t_tile.leaf_hits.sum()/t_tile.nsource
+    hits_block = t_block.leaf_hits.sum()/t_block.nsource
+    assert abs(hits_tile - hits_block) < 0.03*hits_block
+
+
+def test_black_leaves_absorb_weighted_photons():
+    # rho = tau = 0: every photon reaching a leaf is absorbed there, and tallies stay finite
+    arg = benchmark.scene_arg(1, 1, nscat=3, nplevels=0)
+    arg.update(nphotons=2000, weighted=True, rho_leaf=0., tau_leaf=0.)
+    tallies = plantrt.run_batch(arg)[3]
+    assert tallies.leaf_hits.sum() > 0
+    assert np.all(np.isfinite(tallies.leaf_flux))
+    assert np.all(np.isfinite(tallies.ground))
+    np.testing.assert_allclose(tallies.leaf_absorbed, tallies.leaf_flux)
+
+
+def test_leaf_branching_conserves_weight():
+    # A source photon hitting an absorbing leaf splits what is not absorbed between its
+    # reflected self and the child carrying on through the leaf
+    arg = benchmark.scene_arg(1, 1, nplevels=1)
+    arg.update(leaf_absorptance=0.4, rho_leaf=0.1, tau_leaf=0.05)
+    scene = scene_conf.load_scene(arg)
+    batch = plantrt.PhotonBatch(2)
+    ih = batch.add(np.zeros(3), [0., 0., -1.])
+    tallies = plantrt.tally.Tallies.for_scene(arg, scene.nleaves, plantrt.default_observer)
+    plantrt._leaf_interaction(batch, ih, np.ones(1), np.zeros(1, dtype=np.int64), scene, arg,
+                              tallies)
+    assert batch.n == 2
+    np.testing.assert_allclose(batch.weight[:2], [0.4, 0.2])
+    np.testing.assert_allclose(tallies.leaf_absorbed.sum() + batch.weight[:2].sum(), 1.)
+
+
+def test_direct_light_refuses_turbid_bboxes():
+    # shadow rays only test leaf disks, so leaves traced as a turbid medium would cast none
+    arg = benchmark.scene_arg(2, 2)
+    arg.update(lod_bboxes=[1])
+    with pytest.raises(ValueError):
+        plantrt.run_direct(arg)
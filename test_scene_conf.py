@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+import benchmark
+import scene_conf
+
+
+def _scene(grid):
+    return scene_conf.load_scene(benchmark.scene_arg(1, 1), grid=grid)
+
+
+def _rays_at(center, normal):
+    # rays towards the front face of disks, through their centres
+    n = np.asarray(normal, dtype=float)
+    n = n/np.linalg.norm(n, axis=1)[:,None]
+    pos = np.asarray(center, dtype=float) + 5*n
+    with np.errstate(divide='ignore'):
+        return pos, -n, 1./-n
+
+
+@pytest.mark.parametrize('grid', [True, False])
+def test_remove_first_edit(grid):
+    # Removing leaves before any other edit: they can no longer be hit
+    scene = _scene(grid)
+    idl = np.arange(0, scene.nleaves, 2)
+    pos, direction, invdir = _rays_at(scene.leaf['center'][idl], scene.leaf['normal'][idl])
+    assert np.any(np.isin(scene.nearest_leaf(pos, direction, invdir)[1], idl))
+    scene.remove_leaves(idl)
+    assert not np.any(np.isin(scene.nearest_leaf(pos, direction, invdir)[1], idl))
+
+
+@pytest.mark.parametrize('grid', [True, False])
+def test_insert_leaves(grid):
+    # Leaves inserted in the gap between the rows are hit, and only they are
+    scene = _scene(grid)
+    center = [[20., 20., 150.], [180., 280., 150.]]
+    normal = [[0., 0., 1.], [0., 0., 1.]]
+    idl = scene.insert_leaves(center, normal, [5., 5.])
+    assert list(idl) == [scene.nleaves - 2, scene.nleaves - 1]
+    pos, direction, invdir = _rays_at(center, normal)
+    t, ids = scene.nearest_leaf(pos, direction, invdir)
+    np.testing.assert_array_equal(ids, idl)
+    np.testing.assert_allclose(t, 5.)
+
+
+@pytest.mark.parametrize('grid', [True, False])
+def test_modify_leaves(grid):
+    # A moved leaf is hit where it went to and no longer where it was
+    scene = _scene(grid)
+    idl = 10
+    old = scene.leaf['center'][idl].copy()
+    normal = scene.leaf['normal'][idl:idl+1].copy()
+    scene.modify_leaves(idl, center=[[20., 20., 150.]])
+    t, ids = scene.nearest_leaf(*_rays_at([[20., 20., 150.]], normal))
+    assert ids[0] == idl
+    np.testing.assert_allclose(t, 5.)
+    assert scene.nearest_leaf(*_rays_at([old], normal))[1][0] != idl
@@ -0,0 +1,145 @@
+# On-disk photon trajectories.
+# The tracer can stream one fixed-width record per photon and scattering order to a binary
+# file instead of keeping pos_history in memory. Records are buffered in chunks and
+# appended, and a reader memory-maps the file so that slices are only loaded on access.
+#
+#   arg['trajectory'] = 'run.traj'        enable recording (see recorder_for)
+#   arg['trajectory_rate'] = 0.01         keep about 1% of the source photons
+#   arg['trajectory_ids'] = [3, 17]       keep only these source photons
+#   TrajectoryReader('run.traj').select(photon=17)
+
+import os
+import numpy as np
+
+RECORD = np.dtype([('photon', np.int64), # source photon id (global over workers)
+                   ('branch', np.int64), # photon index in its batch
+                   ('prog', np.int64),   # parent branch, -1 for source photons
+                   ('order', np.int32),  # scattering order, 0 at emission
+                   ('pos', np.float64, 3),
+                   ('dir', np.float64, 3),
+                   ('hit', np.int64)])   # leaf hit at this order, -1 for none
+
+MAGIC = b'PLRTTRJ1'
+HEADER = 64 # bytes: magic, record size, zero padding
+
+
+def _sampled(photon, rate):
+    # Deterministic per photon id, so a photon is kept or dropped as a whole whatever
+    # the order or the worker it was traced in
+    if rate >= 1:
+        return np.ones(len(photon), dtype=bool)
+    h = (photon.astype(np.uint64)*np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(11)
+    return h.astype(np.float64)/2.**53 < rate
+
+
+class TrajectoryRecorder:
+    # Appends RECORD rows to path. Only photons passing the sampling rate and, if ids is
+    # given, whose source photon id is in ids are kept. Rows are buffered and written
+    # chunk records at a time
+    def __init__(self, path, rate = 1.0, ids = None, photon_offset = 0, chunk = 1<<16):
+        self.path = path
+        self.rate = rate
+        self.ids = None if ids is None else np.unique(np.asarray(ids, dtype=np.int64))
+        self.photon_offset = photon_offset
+        self.buffer = np.zeros(chunk, dtype=RECORD)
+        self.nbuf = 0
+        self.nrecords = 0
+        header = MAGIC + np.uint32(RECORD.itemsize).tobytes()
+        with open(path, 'wb') as f:
+            f.write(header.ljust(HEADER, b'\0'))
+
+    def record(self, batch, idx, order):
+        # Records photons idx of a PhotonBatch as they are after scattering order `order`
+        prog = batch.prog[idx]
+        photon = np.where(prog >= 0, prog, idx) + self.photon_offset
+        keep = _sampled(photon, self.rate)
+        if self.ids is not None:
+            keep &= np.isin(photon, self.ids)
+        idx, photon = idx[keep], photon[keep]
+
+        rec = np.zeros(len(idx), dtype=RECORD)
+        rec['photon'] = photon
+        rec['branch'] = idx
+        rec['prog'] = batch.prog[idx]
+        rec['order'] = order
+        rec['pos'] = batch.pos[idx]
+        rec['dir'] = batch.dir[idx]
+        rec['hit'] = batch.skip_leaf[idx]
+
+        while len(rec) > 0:
+            k = min(len(rec), len(self.buffer) - self.nbuf)
+            self.buffer[self.nbuf:self.nbuf + k] = rec[:k]
+            self.nbuf += k
+            rec = rec[k:]
+            if self.nbuf == len(self.buffer):
+                self.flush()
+
+    def flush(self):
+        if self.nbuf == 0:
+            return
+        with open(self.path, 'ab') as f:
+            f.write(self.buffer[:self.nbuf].tobytes())
+        self.nrecords += self.nbuf
+        self.nbuf = 0
+
+    def close(self):
+        self.flush()
+
+
+def recorder_for(arg):
+    # TrajectoryRecorder for arg['trajectory'] (path), arg['trajectory_rate'] (default 1),
+    # arg['trajectory_ids'] and arg['photon_offset'], or None if recording is off
+    if not arg.get('trajectory'):
+        return None
+    return TrajectoryRecorder(arg['trajectory'], rate=arg.get('trajectory_rate', 1.0),
+                              ids=arg.get('trajectory_ids'),
+                              photon_offset=arg.get('photon_offset', 0))
+
+
+class TrajectoryReader:
+    # Read-only view of a trajectory file. Records are memory-mapped, so indexing or
+    # iterating over chunks only reads the slices used
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER)
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path}: not a trajectory file')
+        itemsize = int(np.frombuffer(header[len(MAGIC):len(MAGIC)+4], dtype=np.uint32)[0])
+        if itemsize != RECORD.itemsize:
+            raise ValueError(f'{path}: record size {itemsize}, expected {RECORD.itemsize}')
+        n = (os.path.getsize(path) - HEADER)//RECORD.itemsize
+        self.records = np.memmap(path, dtype=RECORD, mode='r', offset=HEADER, shape=(n,)) \
+            if n > 0 else np.zeros(0, dtype=RECORD)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, key):
+        # a copy of the selected records, e.g. reader[1000:2000]
+        return np.array(self.records[key])
+
+    def chunks(self, size = 1<<16):
+        for i0 in range(0, len(self.records), size):
+            yield np.array(self.records[i0:i0+size])
+
+    def select(self, photon = None, order = None, hit_only = False, size = 1<<16):
+        # Records of the given source photon id(s) and/or scattering order(s), scanning the
+        # file chunk by chunk. hit_only keeps leaf interactions only
+        out = []
+        for rec in self.chunks(size):
+            keep = np.ones(len(rec), dtype=bool)
+            if photon is not None:
+                keep &= np.isin(rec['photon'], photon)
+            if order is not None:
+                keep &= np.isin(rec['order'], order)
+            if hit_only:
+                keep &= rec['hit'] >= 0
+            out.append(rec[keep])
+        return np.concatenate(out) if out else np.zeros(0, dtype=RECORD)
+
+    def path_of(self, photon):
+        # All records of one source photon sorted by branch and order: the positions of
+        # branch b are path_of(p)[...]['branch'] == b
+        rec = self.select(photon=photon)
+        return rec[np.lexsort((rec['order'], rec['branch']))]
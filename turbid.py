@@ -0,0 +1,205 @@
+# Turbid-medium level of detail for canopy bboxes.
+# A canopy far from the sensor can be traced as a cloud of leaf area instead of explicit
+# disks. Each such bbox is split into voxels; voxel v holds the one-sided leaf area of the
+# leaves centred in it and, per direction bin, the projected area those leaves present to
+# a photon travelling that way (only the faces hit by the tracer's one-sided leaves count).
+# Divided by the voxel volume this is the extinction coefficient sigma(v, direction), the
+# leaf area density times the G-function of the leaves. Photons sample free paths through
+# the medium with delta tracking (Beer-Lambert), and at a collision one of the voxel's own
+# leaves is drawn with probability proportional to its projected area. The interaction is
+# then that of an explicit hit on the drawn leaf, so per-leaf tallies, materials and
+# optics are unchanged; only where the collision happens is sampled.
+
+import numpy as np
+import accel
+import geometry
+import instrument
+
+
+def direction_bin(direction, nbins):
+    # Index of each direction on a (ncos, nphi) grid uniform in cos(theta) and phi
+    ncos, nphi = nbins
+    ic = np.clip(((direction[:,2] + 1)/2*ncos).astype(np.int64), 0, ncos - 1)
+    phi = np.mod(np.arctan2(direction[:,1], direction[:,0]), 2*np.pi)
+    ip = np.clip((phi/(2*np.pi)*nphi).astype(np.int64), 0, nphi - 1)
+    return ic*nphi + ip
+
+
+def bin_directions(nbins):
+    # Unit vector at the centre of every direction bin, (ncos*nphi, 3)
+    ncos, nphi = nbins
+    cos = (np.arange(ncos) + 0.5)/ncos*2 - 1
+    phi = (np.arange(nphi) + 0.5)/nphi*2*np.pi
+    c, p = np.meshgrid(cos, phi, indexing='ij')
+    s = np.sqrt(1 - c**2)
+    return np.stack([s*np.cos(p), s*np.sin(p), c], axis=-1).reshape(-1, 3)
+
+
+class TurbidMedium:
+    # Voxelised medium standing for the leaves of bboxes `boxes` of a CompiledScene, with
+    # `voxels` (nx, ny, nz) voxels per bbox ((1,1,1) for a homogeneous bbox) and sigma
+    # tabulated on `nbins` direction bins. Voxel v of box k is global voxel k*nvox + v
+    def __init__(self, scene, boxes, voxels = (1,1,1), nbins = (16,32), max_draws = 64,
+                 max_cells = 1<<16):
+        self.boxes = np.asarray(boxes, dtype=np.int64)
+        self.voxels = tuple(int(x) for x in voxels)
+        self.nbins = tuple(int(x) for x in nbins)
+        self.max_draws = max_draws
+        nvox = int(np.prod(self.voxels))
+        nb = len(self.boxes)
+        dims = np.array(self.voxels)
+
+        # leaves of the medium boxes, by box then voxel
+        leaf_box = np.full(len(scene.bounds), -1, dtype=np.int64)
+        leaf_box[self.boxes] = np.arange(nb)
+        kbox = leaf_box[scene.leaf['bbox']]
+        ids = np.flatnonzero((kbox >= 0) & (scene.leaf['r2'] >= 0))
+        kbox = kbox[ids]
+        center = scene.leaf['center'][ids]
+        area = np.pi*scene.leaf['radius'][ids]**2
+
+        # voxel grids span the bbox, grown to hold every leaf centre
+        self.lo = np.array(scene.bounds, dtype=float)[self.boxes,0]
+        self.hi = np.array(scene.bounds, dtype=float)[self.boxes,1]
+        if len(ids) > 0:
+            np.minimum.at(self.lo, kbox, center)
+            np.maximum.at(self.hi, kbox, center)
+        self.hi = np.maximum(self.hi, self.lo + 1e-9)
+        self.cell = (self.hi - self.lo)/dims
+
+        ijk = np.clip(np.floor((center - self.lo[kbox])/self.cell[kbox]).astype(np.int64),
+                      0, dims - 1)
+        vox = kbox*nvox + (ijk[:,0]*dims[1] + ijk[:,1])*dims[2] + ijk[:,2]
+        self.vox_start, self.vox_items = accel.csr(vox, ids, nb*nvox)
+        self.vox_amax = np.zeros(nb*nvox)
+        np.maximum.at(self.vox_amax, vox, area)
+
+        # sigma per voxel and direction bin: projected leaf area over voxel volume
+        dirs = bin_directions(self.nbins)
+        self.sigma = np.zeros((nb*nvox, len(dirs)))
+        normal = scene.leaf['normal'][ids]
+        for i0 in range(0, len(ids), 1<<14):
+            sl = slice(i0, i0 + (1<<14))
+            proj = area[sl,None]*np.maximum(-normal[sl] @ dirs.T, 0)
+            np.add.at(self.sigma, vox[sl], proj)
+        self.sigma /= np.prod(self.cell, axis=1).repeat(nvox)[:,None]
+        # majorant of every box per direction bin
+        self.sigma_max = self.sigma.reshape(nb, nvox, -1).max(axis=1)
+
+        # coarse lookup grid over all the boxes, cells about half a box wide: the boxes
+        # overlapping cell c are lookup_items[lookup_start[c]:lookup_start[c+1]]. The
+        # majorant bounds the summed sigma of any cell, per direction bin
+        self.union = np.array([self.lo.min(axis=0), self.hi.max(axis=0)]) if nb > 0 \
+            else np.zeros((2,3))
+        size = np.maximum(self.union[1] - self.union[0], 1e-9)
+        cell = np.median(self.hi - self.lo, axis=0)/2 if nb > 0 else size
+        self.lookup_dims = np.maximum(np.ceil(size/np.maximum(cell, 1e-9)), 1).astype(np.int64)
+        while np.prod(self.lookup_dims) > max_cells:
+            self.lookup_dims = np.maximum(self.lookup_dims//2, 1)
+        self.lookup_cell = size/self.lookup_dims
+        box, ijk = accel.box_cells(self._lookup_index(self.lo), self._lookup_index(self.hi))
+        cid = self._lookup_linear(ijk)
+        ncell = int(np.prod(self.lookup_dims))
+        self.lookup_start, self.lookup_items = accel.csr(cid, box, ncell)
+        cell_sigma = np.zeros((ncell, len(dirs)))
+        np.add.at(cell_sigma, cid, self.sigma_max[box])
+        self.majorant = cell_sigma.max(axis=0)
+
+        self.normal = scene.leaf['normal']
+        self.radius = scene.leaf['radius']
+
+    @property
+    def nvox(self):
+        return int(np.prod(self.voxels))
+
+    def _lookup_index(self, x):
+        ijk = np.floor((x - self.union[0])/self.lookup_cell).astype(np.int64)
+        return np.clip(ijk, 0, self.lookup_dims - 1)
+
+    def _lookup_linear(self, ijk):
+        return (ijk[:,0]*self.lookup_dims[1] + ijk[:,1])*self.lookup_dims[2] + ijk[:,2]
+
+    def _voxel(self, k, x):
+        dims = np.array(self.voxels)
+        ijk = np.clip(np.floor((x - self.lo[k])/self.cell[k]).astype(np.int64), 0, dims - 1)
+        return k*self.nvox + (ijk[:,0]*dims[1] + ijk[:,1])*dims[2] + ijk[:,2]
+
+    def collide(self, pos, direction, t_max, rng):
+        # Free-path sampling through the medium: distance to the first collision before
+        # t_max along each ray (inf if none) and the leaf drawn there (-1 if none)
+        n = len(pos)
+        t_best = np.array(t_max, dtype=float)
+        vox_best = np.full(n, -1, dtype=np.int64)
+        if len(self.boxes) == 0 or n == 0:
+            return np.full(n, np.inf), vox_best
+
+        # rays are only tracked through the box enclosing the whole medium
+        with np.errstate(divide='ignore'):
+            invdir = 1./direction
+        t0, t1 = geometry.raybox_interval(pos, invdir, self.union[None])
+        t0 = np.maximum(t0[:,0], 0.)
+        t1 = np.minimum(t1[:,0], t_best)
+        dbin = direction_bin(direction, self.nbins)
+        smax = self.majorant[dbin]
+        ray = np.flatnonzero((t0 < t1) & (smax > 0))
+        s, end, smax = t0[ray], t1[ray], smax[ray]
+
+        # delta tracking: tentative collisions at the majorant rate, each accepted with
+        # probability sigma/majorant, sigma summed over the boxes containing the point
+        while len(ray) > 0:
+            s = s - np.log(1 - rng.random(len(ray)))/smax
+            inside = s < end
+            ray, s, end, smax = ray[inside], s[inside], end[inside], smax[inside]
+            x = pos[ray] + s[:,None]*direction[ray]
+
+            # (point, box) pairs for the boxes listed in the lookup cell of each point
+            c = self._lookup_linear(self._lookup_index(x))
+            start = self.lookup_start[c]
+            pr, k = accel.expand(start, self.lookup_start[c+1] - start, self.lookup_items)
+            inbox = np.all((x[pr] >= self.lo[k]) & (x[pr] <= self.hi[k]), axis=1)
+            pr, k = pr[inbox], k[inbox]
+            v = self._voxel(k, x[pr])
+            sig = self.sigma[v, dbin[ray[pr]]]
+
+            # the pair whose share of the cumulated sigma holds u*majorant, if any
+            cs = np.cumsum(sig)
+            first = np.r_[True, pr[1:] != pr[:-1]] if len(pr) > 0 else np.zeros(0, dtype=bool)
+            base = np.zeros(len(ray))
+            base[pr[first]] = (cs - sig)[first]
+            u = rng.random(len(ray))*smax + base
+            chosen = (cs - sig <= u[pr]) & (u[pr] < cs)
+            hit = pr[chosen]
+            accel.reduce_nearest(ray[hit], s[hit], v[chosen], t_best, vox_best)
+            if instrument.enabled:
+                instrument.count('medium_steps', len(ray))
+            go = np.ones(len(ray), dtype=bool)
+            go[hit] = False
+            ray, s, end, smax = ray[go], s[go], end[go], smax[go]
+
+        t = np.where(vox_best >= 0, t_best, np.inf)
+        idl = np.full(n, -1, dtype=np.int64)
+        sel = np.flatnonzero(vox_best >= 0)
+        idl[sel] = self.draw_leaf(vox_best[sel], direction[sel], rng)
+        if instrument.enabled:
+            instrument.count('medium_collisions', len(sel))
+        return t, idl
+
+    def draw_leaf(self, vox, direction, rng):
+        # A leaf of each voxel drawn with probability proportional to the area it presents
+        # to the photon (rejection sampling). After max_draws rejections the last
+        # candidate is kept, which only happens when the exact direction meets hardly
+        # any leaf face of the voxel
+        start = self.vox_start[vox]
+        count = self.vox_start[vox + 1] - start
+        out = np.full(len(vox), -1, dtype=np.int64)
+        todo = np.flatnonzero(count > 0)
+        for draw in range(self.max_draws):
+            if len(todo) == 0:
+                break
+            j = self.vox_items[start[todo] + (rng.random(len(todo))*count[todo]).astype(np.int64)]
+            w = np.pi*self.radius[j]**2/self.vox_amax[vox[todo]]* \
+                np.maximum(-np.sum(self.normal[j]*direction[todo], axis=1), 0)
+            ok = (rng.random(len(todo)) < w) | (draw == self.max_draws - 1)
+            out[todo[ok]] = j[ok]
+            todo = todo[~ok]
+        return out
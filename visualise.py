@@ -12,6 +12,7 @@ from mpl_toolkits.mplot3d import proj3d
 from matplotlib.patches import Circle, PathPatch
 from matplotlib.transforms import Affine2D
 from mpl_toolkits.mplot3d import art3d
+import geometry
 
 
 
@@ -98,6 +99,80 @@ def plot_disk(ax, point, normal, size=10, color='y'):
     pathpatch_translate(p, (point[0], point[1], point[2]))
 
 
+def disk_polygons(center, normal, radius, nsides = 12):
+    # Vertices of all leaf disks at once, (m, nsides, 3): each disk is a regular polygon
+    # in the plane spanned by two unit vectors perpendicular to its normal
+    center = np.asarray(center, dtype=float)
+    u, v = geometry.disk_basis(normal)
+    ang = np.linspace(0, 2*np.pi, nsides, endpoint=False)
+    r = np.asarray(radius, dtype=float)[:,None,None]
+    return center[:,None,:] + r*(np.cos(ang)[None,:,None]*u[:,None,:] +
+                                 np.sin(ang)[None,:,None]*v[:,None,:])
+
+
+def scene_leaves(scene):
+    # World-space center, normal, radius of the leaves of a CompiledScene, an
+    # InstancedScene or a packed leaf dict
+    if hasattr(scene, 'leaf_center'):
+        idl = np.arange(scene.nleaves)
+        return scene.leaf_center(idl), scene.leaf_normal(idl), scene.leaf_radius(idl)
+    return np.asarray(scene['center']), np.asarray(scene['normal']), np.asarray(scene['radius'])
+
+
+def decimate(m, max_items, seed = 0):
+    # Level of detail: indices of a random subset of at most max_items out of m, and the
+    # factor m/len(subset) by which each kept item stands for the dropped ones
+    if max_items is None or m <= max_items:
+        return np.arange(m), 1.
+    keep = np.sort(np.random.default_rng(seed).choice(m, max_items, replace=False))
+    return keep, m/max_items
+
+
+def plot_canopy(ax, scene, nsides = 12, max_leaves = None, color = 'g', alpha = 1.0,
+                seed = 0, **kwargs):
+    # Batched alternative to plot_disk for whole scenes: every leaf polygon is computed with
+    # numpy and drawn through a single Poly3DCollection. With max_leaves only a random
+    # subset is drawn, with radii scaled up so that the drawn leaf area is unchanged.
+    # Extra keyword arguments go to Poly3DCollection
+    center, normal, radius = scene_leaves(scene)
+    keep, factor = decimate(len(radius), max_leaves, seed)
+    verts = disk_polygons(center[keep], normal[keep], radius[keep]*np.sqrt(factor), nsides)
+    coll = Poly3DCollection(verts, facecolors=color, alpha=alpha, **kwargs)
+    ax.add_collection3d(coll)
+    return coll
+
+
+def trajectory_segments(pos_history, path_history = None):
+    # (nseg, 2, 3) segments travelled between scattering orders from the per-order
+    # positions returned by the tracer (pos_history[k] has one row per photon alive so far,
+    # new branches are appended). Photons that did not move are left out.
+    # Within one order a photon can cross several scene walls, so its chord from one order
+    # to the next is not what it travelled. Given the tracer's batch.path_history, segments
+    # whose length differs from the path travelled are dropped
+    segments = []
+    for k, (prev, cur) in enumerate(zip(pos_history[:-1], pos_history[1:])):
+        cur = cur[:len(prev)]
+        moved = np.any(prev != cur, axis=1)
+        if path_history is not None:
+            step = path_history[k+1][:len(prev)] - path_history[k]
+            moved &= np.isclose(np.linalg.norm(cur - prev, axis=1), step, rtol=1e-6, atol=1e-6)
+        segments.append(np.stack([prev[moved], cur[moved]], axis=1))
+    return np.concatenate(segments) if segments else np.zeros((0,2,3))
+
+
+def plot_trajectories(ax, pos_history, max_paths = None, color = 'k', alpha = 0.3,
+                      linewidth = 0.5, seed = 0, path_history = None, **kwargs):
+    # Draws photon paths as one Line3DCollection, optionally for a random subset of at most
+    # max_paths segments. Pass the tracer's batch.path_history to leave out the chords of
+    # photons that crossed scene walls (see trajectory_segments)
+    segments = trajectory_segments(pos_history, path_history)
+    keep, factor = decimate(len(segments), max_paths, seed)
+    coll = art3d.Line3DCollection(segments[keep], colors=color, alpha=alpha,
+                                  linewidths=linewidth, **kwargs)
+    ax.add_collection3d(coll)
+    return coll
+
+
 o = np.array([5,5,5])
 v = np.array([3,3,3])
 n = [0.5, 0.5, 0.5]